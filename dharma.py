@@ -14,7 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import sys, os, random, re, getopt, math, shutil
+import sys, os, random, re, getopt, math, shutil, hashlib, tempfile, cPickle, cStringIO, multiprocessing, heapq, itertools, socket, struct, errno, traceback, urlparse, BaseHTTPServer, SocketServer, json, timeit, bisect, ctypes, subprocess, collections, threading, Queue, time, select
 
 class dharma_const:
 	VOID_SECTION = 0
@@ -35,26 +35,175 @@ class dharma_const:
 	VARIANCE_PREFIX = ""
 	VARIANCE_SUFFIX = ""
 
-	DHARMA_ARGS = "f:i:n:o:p:s:t:"
+	DHARMA_ARGS = "c:Cf:i:j:n:o:p:s:t:"
+	DHARMA_LONG_ARGS = ["seed=", "max-bytes=", "max-depth=", "max-nodes=", "stream=", "delimiter=", "index=", "serve=", "profile=", "coverage=", "dedup", "dedup-state=", "record-trees", "reduce=", "predicate=", "mutate=", "pool=", "fanout=", "watch=", "analyze="]
+	DHARMA_VERSION = "1.8"
 	DEFAULT_COUNT = 1
 	DEFAULT_TABS = 0
 	DEFAULT_FILETYPE = "html"
+	DEFAULT_JOBS = 1
+	STREAM_STDOUT = "-"
+	STREAM_UNIX_PREFIX = "unix:"
+	STREAM_LENGTH_FORMAT = "!I"
+	SERVE_HOST = "127.0.0.1"
 	MAX_REPEAT_POWER = 12
 
 	LEAF_TRIGGER = 256
 
+	MAX_OUTPUT_BYTES = 0
+	MAX_EXPANSION_DEPTH = 0
+	MAX_EXPANSION_NODES = 0
+	BUDGET_RATIO = 0.75
+
+	LITERAL_SEGMENT = 0
+	VALUE_SEGMENT = 1
+	VARIABLE_SEGMENT = 2
+	ELEMENT_SEGMENT = 3
+	RANGE_SEGMENT = 4
+	REPEAT_SEGMENT = 5
+
+	CHAR_RANGE = 0
+	INT_RANGE = 1
+	FLOAT_RANGE = 2
+
 	IMPORT_TMP = "import_tmp"
 
+	CACHE_EXTENSION = "c"
+	UNIT_CACHE_EXTENSION = "o"
+	COVERAGE_PAIR_BONUS = 2.0
+
+	DEDUP_BITS = 1 << 24
+	DEDUP_HASHES = 7
+	DEDUP_RETRIES = 8
+	DEDUP_MAGIC = "DGBF"
+	DEDUP_HEADER_FORMAT = "!4sII"
+
+	TREE_EXTENSION = ".dgt"
+	REDUCED_INFIX = ".reduced"
+	MUTATE_SPLICE_RATIO = 0.5
+	POOL_SIZE = 32
+	POOL_REUSE_RATIO = 0.5
+	WRITER_QUEUE = 64
+	FANOUT_WIDTH = 2
+	WATCH_POLL_INTERVAL = 0.5
+	WATCH_EVENT_BUFFER = 4096
+	INOTIFY_MOVED_FROM = 0x40
+	INOTIFY_DELETE = 0x200
+	ANALYSIS_ITERATIONS = 1000
+	ANALYSIS_TOLERANCE = 1e-9
+	ANALYSIS_LIMIT = 1e15
+	ANALYSIS_TAIL = 0.01
+	FLOAT_DIGITS = 12
+	MANIFEST_FILE = "dharma.manifest"
+
+class dharma_error(Exception):
+	pass
+
+class dharma_stream_closed(dharma_error):
+	pass
+
+# dharma_const as seen by one grammar. %const% settings and command line budgets are kept here
+# instead of being set on dharma_const, so grammars loaded side by side do not interfere
+class dharma_consts:
+
+	def __init__(self, consts=[]):
+		for (const, val) in consts:
+			setattr(self, const, val)
+
+	def __getattr__(self, name):
+		return getattr(dharma_const, name)
+
+# the state of one generator: its random stream, constants, per-testcase budget accounting and
+# leaf mode, variable element counts and defaults, fragment pools and the optional collectors.
+# a resolved grammar is only read while generating, so every thread can run its own context
+class dharma_context:
+
+	def __init__(self, consts=[], seed=0):
+		self.const = dharma_consts(consts)
+		self.rng = random.Random()
+		self.seed = seed
+
+		# dharma_profile collecting per-alternative statistics, None when profiling is off
+		self.profile = None
+
+		# dharma_coverage steering selection toward unexplored alternatives, None when off
+		self.coverage = None
+
+		# keep the derivation tree of every expansion as dharma_node fragment lists
+		self.record = False
+		self.tree = None
+
+		self.counts = {}
+		self.defaults = {}
+		self.default_trees = {}
+		self.pools = {}
+
+		self.reset()
+
+	# every testcase number gets its own random stream derived from the base seed, so any
+	# single testcase can be regenerated without generating the ones before it
+	def seed_testcase(self, index, attempt=0):
+		if attempt != 0:
+			self.rng.seed(long(hashlib.sha1("%d:%d:%d" % (self.seed, index, attempt)).hexdigest(), 16))
+		else:
+			self.rng.seed(long(hashlib.sha1("%d:%d" % (self.seed, index)).hexdigest(), 16))
+
+		return
+
+	# clear the per-testcase state. pools only live for one testcase as well, so a testcase
+	# still depends on nothing but its seed
+	def reset(self):
+		self.output_bytes = 0
+		self.pending_bytes = 0
+		self.nodes = 0
+		self.converge = False
+		self.leaf_mode = False
+		self.leaf_trigger = 0
+
+		self.counts.clear()
+		self.defaults.clear()
+		self.default_trees.clear()
+		self.pools.clear()
+
+		if self.profile != None:
+			self.profile.start_testcase()
+
+		return
+
 class dharma_object:
 	depth = 0
 
+	REPEAT_REGEX = re.compile("\%repeat\%\((?P<repval>.*?)\)", re.S)
+	REPEAT_SEPARATOR_REGEX = re.compile("(?P<repval>.*),[ ]*\"(?P<sepval>.*?)\"[ ]*$", re.S)
+	RANGE_REGEX = re.compile("\%range\%\((?P<rangeval>.*?)\)", re.S)
+	RANGE_BOUNDS_REGEX = re.compile("^(?P<startval>.*)-(?P<endval>.*?)$", re.S)
+	XREF_REGEX = re.compile("\+(?P<value>[a-zA-Z0-9_]+)\+|\!(?P<variable>[a-zA-Z0-9_]+)\!|\@(?P<element>[a-zA-Z0-9_]+)\@")
+	VALUE_XREF_REGEX = re.compile("\+(?P<value>[a-zA-Z0-9_]+)\+|\!(?P<variable>[a-zA-Z0-9_]+)\!")
+	WEIGHT_REGEX = re.compile("^\%weight\%\((?P<weight>[0-9]*\.?[0-9]+)\)")
+
 	def __init__(self, ident):
 		self.ident = ident
 		self.value_xref = {}
 		self.variable_xref = {}
 		self.element_xref = {}
+		self.cost = []
+		self.leaf = []
+		self.depth = None
+		self.size = None
+		self.weights = []
+		self.alias = None
+		self.leaf_alias = None
+		self.pooled = False
 		return
 
+	# resolved xrefs are stored by name only and relinked by resolve_xref on load
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		state["value_xref"] = dict.fromkeys(self.value_xref, -1)
+		state["variable_xref"] = dict.fromkeys(self.variable_xref, -1)
+		state["element_xref"] = dict.fromkeys(self.element_xref, -1)
+		return state
+
 	def add_value_xref(self, value):
 		self.value_xref[value] = -1
 		return
@@ -67,836 +216,3179 @@ class dharma_object:
 		self.element_xref[element] = -1
 		return
 
-	def eval_variable_xref(self, token):
-		m = re.search("\!(?P<xref>[a-zA-Z0-9_]+)\!", token)
+	# strip a leading %weight%(N) from an alternative, alternatives without one weigh 1
+	def parse_weight(self, token):
+		m = dharma_object.WEIGHT_REGEX.match(token)
 
 		if m == None:
+			self.weights.append(1.0)
 			return token
 
-		xref = m.group("xref")
-
-		if not xref in self.variable_xref:
-			print "e: variable xref inconsistency in " + self.ident + " looking for " + xref + " on token " + token
-			sys.exit(-1)
-
-		prefix = token[:m.start("xref")-1]
+		self.weights.append(float(m.group("weight")))
 
-		variable = self.variable_xref[xref].generate()
-		
-		suffix = token[m.end("xref")+1:]
+		return token[m.end():]
 
-		suffix = self.eval_variable_xref(suffix)
+	# alias tables are only built for rules with unequal weights, the others keep drawing a
+	# uniform index. leaf mode draws from the weights of the leaf alternatives
+	def build_alias(self):
+		self.alias = None
+		self.leaf_alias = None
 
-		return prefix + variable + suffix
+		if len(set(self.weights)) < 2:
+			return
 
-	def eval_value_xref(self, token):
-		m = re.search("\+(?P<xref>[a-zA-Z0-9_]+)\+", token)
+		if sum(self.weights) <= 0:
+			raise dharma_error("all alternatives of " + rule_name(self) + " have zero weight")
 
-		if m == None:
-			return token
+		self.alias = alias_table(self.weights)
 
-		xref = m.group("xref")
+		weights = [self.weights[i] for i in self.leaf]
 
-		if not xref in self.value_xref:
-			print "e: value xref inconsistency in " + self.ident + " for " + xref
-			sys.exit(-1)
+		if len(set(weights)) > 1 and sum(weights) > 0:
+			self.leaf_alias = alias_table(weights)
 
-		prefix = token[:m.start("xref")-1]
+		return
 
-		value = self.value_xref[xref].generate()
+	# keep a fresh expansion for reuse, a full pool replaces a random entry so it keeps refreshing
+	def add_pooled(self, ctx, fragment):
+		pool = ctx.pools.setdefault(self, [])
 
-		suffix = token[m.end("xref")+1:]
+		if len(pool) < ctx.const.POOL_SIZE:
+			pool.append(fragment)
+		else:
+			pool[ctx.rng.randint(0, len(pool)-1)] = fragment
 
-		suffix = self.eval_value_xref(suffix)
+		return
 
-		return prefix + value + suffix
+	def set_weight(self, alt, weight):
+		if alt < 0 or alt >= len(self.weights):
+			raise dharma_error("no alternative %d in %s" % (alt, rule_name(self)))
 
-	def eval_element_xref(self, token):
-		m = re.search("\@(?P<xref>[a-zA-Z0-9_]+)\@", token)
+		if weight < 0:
+			raise dharma_error("negative weight for alternative %d of %s" % (alt, rule_name(self)))
 
-		if m == None:
-			return token
+		old = self.weights[alt]
+		self.weights[alt] = float(weight)
 
-		xref = m.group("xref")
+		try:
+			self.build_alias()
+		except dharma_error:
+			self.weights[alt] = old
+			raise
 
-		if not xref in self.element_xref:
-			print "e: element xref inconsistency in " + self.ident + " for " + xref
-			sys.exit(-1)
+		return
 
-		prefix = token[:m.start("xref")-1]
-		element = self.element_xref[xref].new_element()
-		suffix = token[m.end("xref")+1:]
+	# lower a template into literal, xref, %range% and %repeat% segments
+	def parse_segments(self, token, element=True):
+		if token.find("%") == -1:
+			return self.parse_xref_segments(token, element)
 
-		suffix = self.eval_element_xref(suffix)
+		segments = []
+		pos = 0
 
-		return prefix + element + suffix
+		for m in dharma_object.REPEAT_REGEX.finditer(token):
+			segments.extend(self.parse_range_segments(token[pos:m.start()], element))
 
-	def eval_meta(self, line):
-		line = self.meta_repeat(line)
-		line = self.meta_range(line)
+			repval = m.group("repval")
 
-		return line
+			s = dharma_object.REPEAT_SEPARATOR_REGEX.search(repval)
 
-	def meta_repeat(self, line):
-		m = re.search("\%repeat\%\((?P<repval>.*?)\)", line, re.S)
+			if s != None:
+				repval = s.group("repval")
+				sepval = s.group("sepval")
+			else:
+				sepval = ""
 
-		if m == None:
-			return line
+			repval = self.parse_xref_segments(repval, element)
+			sepval = self.parse_xref_segments(sepval, element)
 
-		repval = m.group("repval")
+			segments.append((dharma_const.REPEAT_SEGMENT, (repval, sepval)))
+			pos = m.end()
 
-		s = re.search("(?P<repval>.*),[ ]*\"(?P<sepval>.*?)\"[ ]*$", repval, re.S)
+		segments.extend(self.parse_range_segments(token[pos:], element))
 
-		if s != None:
-			repval = s.group("repval")
-			sepval = s.group("sepval")
-		else:
-			sepval = ""
+		return segments
 
-		prefix = line[:m.start()]
-		suffix = line[m.end():]
+	def parse_range_segments(self, token, element):
+		segments = []
+		pos = 0
 
-		nrep_max = math.pow(2, random.randint(1, dharma_const.MAX_REPEAT_POWER))
-		nrep = random.randint(1,nrep_max)
+		for m in dharma_object.RANGE_REGEX.finditer(token):
+			segments.extend(self.parse_xref_segments(token[pos:m.start()], element))
+			segments.append((dharma_const.RANGE_SEGMENT, self.parse_range(m.group("rangeval"))))
+			pos = m.end()
 
-		out = prefix
+		segments.extend(self.parse_xref_segments(token[pos:], element))
 
-		for i in range(0, nrep):
-			out += repval
-			if i != nrep - 1:
-				out += sepval
+		return segments
 
-		out += suffix
+	def parse_xref_segments(self, token, element):
+		if element:
+			regex = dharma_object.XREF_REGEX
+		else:
+			regex = dharma_object.VALUE_XREF_REGEX
 
-		out = self.meta_repeat(out)
+		segments = []
+		pos = 0
 
-		return out
+		for m in regex.finditer(token):
+			if m.start() != pos:
+				segments.append((dharma_const.LITERAL_SEGMENT, token[pos:m.start()]))
 
-	def meta_range(self, line):
-		m = re.search("\%range\%\((?P<rangeval>.*?)\)", line, re.S)
+			if m.group("value") != None:
+				segments.append((dharma_const.VALUE_SEGMENT, m.group("value")))
+			elif m.group("variable") != None:
+				segments.append((dharma_const.VARIABLE_SEGMENT, m.group("variable")))
+			else:
+				segments.append((dharma_const.ELEMENT_SEGMENT, m.group("element")))
 
-		if m == None:
-			return line
+			pos = m.end()
 
-		rangeval = m.group("rangeval")
+		if pos != len(token):
+			segments.append((dharma_const.LITERAL_SEGMENT, token[pos:]))
 
-		prefix = line[:m.start()]
-		suffix = line[m.end():]
+		return segments
 
-		s = re.match("^(?P<startval>.*)-(?P<endval>.*?)$", rangeval, re.S)
+	def parse_range(self, rangeval):
+		s = dharma_object.RANGE_BOUNDS_REGEX.match(rangeval)
 
 		if s == None:
-			print "e: malformed range meta"
-			sys.exit(-1)
+			raise dharma_error("malformed range meta")
 
 		startval = s.group("startval")
 		endval = s.group("endval")
 
 		if len(startval) == 1 and len(endval) == 1:
-			start_idx = ord(startval[0])
-			end_idx = ord(endval[0])
-
-			outval = chr(random.randint(start_idx, end_idx))
+			return self.range_bounds(dharma_const.CHAR_RANGE, ord(startval[0]), ord(endval[0]))
 		elif startval.find(".") == -1:
 			# integer range
 			if not endval.find(".") == -1:
-				print "e: range meta int/float mismatch in " + self.ident
-				sys.exit(-1)
+				raise dharma_error("range meta int/float mismatch in " + self.ident)
 
 			try:
 				start_idx = int(startval)
 				end_idx = int(endval)
 			except:
-				print "e: meta range integer conversion error"
-				sys.exit(-1)
+				raise dharma_error("meta range integer conversion error")
 
-			outval = str(random.randint(start_idx, end_idx))
+			return self.range_bounds(dharma_const.INT_RANGE, start_idx, end_idx)
 		else:
 			# floating point range
 			if endval.find(".") == -1:
-				print "e: range meta float/int mismatch"
-				sys.exit(-1)
+				raise dharma_error("range meta float/int mismatch")
 
 			try:
 				start_idx = float(startval)
 				end_idx = float(endval)
 			except:
-				print "e: meta range float conversion error"
-				sys.exit(-1)
-
-			outval = str(random.uniform(start_idx, end_idx))
-
-		out = prefix + outval + suffix
+				raise dharma_error("meta range float conversion error")
+
+			return self.range_bounds(dharma_const.FLOAT_RANGE, start_idx, end_idx)
+
+	# reversed bounds would only fail once the range is drawn from
+	def range_bounds(self, range_type, start_idx, end_idx):
+		if start_idx > end_idx:
+			raise dharma_error("range meta start is above its end in " + self.ident)
+
+		return (range_type, start_idx, end_idx)
+
+	# output size of the template with each %repeat% taken once, and the values it expands;
+	# variable defaults are generated at most once per testcase so they are not followed
+	def segment_cost(self, segments):
+		size = 0
+		refs = []
+		repeat = False
+
+		for seg in segments:
+			seg_type = seg[0]
+
+			if seg_type == dharma_const.LITERAL_SEGMENT:
+				size += len(seg[1])
+			elif seg_type == dharma_const.VALUE_SEGMENT:
+				refs.append(self.value_xref[seg[1]])
+			elif seg_type == dharma_const.VARIABLE_SEGMENT or seg_type == dharma_const.ELEMENT_SEGMENT:
+				size += len(seg[1]) + 1
+			elif seg_type == dharma_const.RANGE_SEGMENT:
+				(range_type, start_idx, end_idx) = seg[1]
+
+				if range_type == dharma_const.CHAR_RANGE:
+					size += 1
+				else:
+					size += min(len(str(start_idx)), len(str(end_idx)))
+			else:
+				(repsize, reprefs) = self.segment_cost(seg[1][0])[:2]
+				size += repsize
+				refs.extend(reprefs)
+				repeat = True
 
-		out = self.meta_range(out)
+		return (size, refs, repeat)
 
-		return out
+	# draw the repetition count of every %repeat% in the template, before any range is evaluated
+	def meta_repeat(self, ctx, segments):
+		counts = []
 
-class dharma_value(dharma_object):
-	leaf_mode = False
-	leaf_trigger = 0
+		for seg in segments:
+			if seg[0] != dharma_const.REPEAT_SEGMENT:
+				continue
 
-	def __init__(self, ident):
-		dharma_object.__init__(self, ident)
-		self.values = []
-		self.leaf = []
-		self.leaf_path = []
-		return
+			if ctx.converge:
+				counts.append(1)
+				continue
 
-	def add_value(self, value):
-		self.values.append(value)
+			nrep_max = math.pow(2, ctx.rng.randint(1, ctx.const.MAX_REPEAT_POWER))
+			nrep = ctx.rng.randint(1,nrep_max)
+			cap = self.repeat_cap(ctx, seg[1][0], counts)
 
-		m = re.search("\+[a-zA-Z0-9_]+\+", value)
+			if cap != None and nrep > cap:
+				nrep = cap
 
-		if m != None:
-			return
+			counts.append(nrep)
 
-		m = re.search("\%repeat\%\(.*?\)", value)
+		return counts
 
-		if m != None:
-			return
+	# the most repetitions of a %repeat% body that still fit in the output and node budgets,
+	# counting each repetition at its minimum cost and the repetitions already drawn in front of it
+	def repeat_cap(self, ctx, segments, counts):
+		cap = None
+		ratio = ctx.const.BUDGET_RATIO
+		(size, refs) = self.segment_cost(segments)[:2]
 
-		self.leaf.append(value)
+		for ref in refs:
+			if ref.size != None:
+				size += ref.size
 
-		return
+		if ctx.const.MAX_OUTPUT_BYTES > 0 and size > 0:
+			left = ctx.const.MAX_OUTPUT_BYTES * ratio - ctx.output_bytes - ctx.pending_bytes
+			cap = int(left / size)
 
-	def add_leaf_path(self, leaf, path, depth):
-		self.leaf_path.append((leaf, path, depth))
-		return
+		if ctx.const.MAX_EXPANSION_NODES > 0 and len(refs) > 0:
+			left = ctx.const.MAX_EXPANSION_NODES * ratio - ctx.nodes
+			nodes = int(left / len(refs))
 
-	def generate(self):
-		if dharma_value.leaf_mode == False:
-			dharma_value.leaf_trigger += 1
+			if cap == None or nodes < cap:
+				cap = nodes
 
-			if dharma_value.leaf_trigger > dharma_const.LEAF_TRIGGER:
-				dharma_value.leaf_mode = True
+		if cap == None:
+			return cap
 
-		if len(self.values) == 0:
-			return ""
-		elif dharma_value.leaf_mode == True:
-			if len(self.leaf) != 0:
-				sval = random.randint(0, len(self.leaf)-1)
-				value = self.leaf[sval]
-			else:
-				# favour non-repeating
-				favourite_values = []
-				for val in self.values:
-					m = re.search("\%repeat\%\((?P<repval>.*?)\)", val)
+		# repetitions drawn earlier in this template share the same budget
+		cap -= sum(counts)
 
-					if m == None:
-						favourite_values.append(val)
+		return max(cap, 1)
 
-				if len(favourite_values) == 0:
-					favourite_values = self.values
+	def meta_range(self, ctx, rangeval):
+		(range_type, start_idx, end_idx) = rangeval
 
-				# find the outputs with the smallest number of value references
-				minimized_values = []
-				for i in range(1, 8):
-					if len(minimized_values) != 0:
-						break
+		if range_type == dharma_const.CHAR_RANGE:
+			return chr(ctx.rng.randint(start_idx, end_idx))
+		elif range_type == dharma_const.INT_RANGE:
+			return str(ctx.rng.randint(start_idx, end_idx))
+		else:
+			return str(ctx.rng.uniform(start_idx, end_idx))
 
-					for val in favourite_values:
-						val_token = val
-						count = 0;
+	# when any per-testcase budget is close to running out, converge by switching to the
+	# cheapest terminating alternatives and single repetitions for the rest of the testcase
+	def check_budget(self, ctx, depth):
+		if ctx.converge:
+			return
 
-						m = re.search("\+[a-zA-Z0-9_]+\+", val_token)
+		ratio = ctx.const.BUDGET_RATIO
 
-						while m != None:
-							count += 1
-							val_token = val_token[m.end():]
+		if ctx.const.MAX_OUTPUT_BYTES > 0:
+			if ctx.output_bytes + ctx.pending_bytes >= ctx.const.MAX_OUTPUT_BYTES * ratio:
+				ctx.converge = True
 
-							m = re.search("\+[a-zA-Z0-9_]+\+", val_token)
+		if ctx.const.MAX_EXPANSION_NODES > 0:
+			if ctx.nodes >= ctx.const.MAX_EXPANSION_NODES * ratio:
+				ctx.converge = True
 
-						if count <= i:
-							minimized_values.append(val)
+		if ctx.const.MAX_EXPANSION_DEPTH > 0 and self.depth != None:
+			if depth + self.depth >= ctx.const.MAX_EXPANSION_DEPTH * ratio:
+				ctx.converge = True
 
-				if len(minimized_values) == 0:
-					minimized_values = favourite_values
+		if ctx.converge:
+			ctx.leaf_mode = True
 
-				path_idents = []
-				for p in self.leaf_path:
-					path_idents.append(p[1])
+			if ctx.profile != None:
+				ctx.profile.converges += 1
 
-				mv_len = len(minimized_values)
-				sval = random.randint(0, mv_len-1)
+		return
 
-				for i in range(mv_len):
-					out = minimized_values[sval]
+	def expand(self, ctx, depth):
+		self.check_budget(ctx, depth)
 
-					is_leaf_path = True
+		sel = self.select(ctx)
 
-					suffix = out
-					m = re.search("\+(?P<xref>[a-zA-Z0-9_]+)\+", suffix)
+		if sel == None:
+			frame = dharma_frame(ctx, self, [])
+		else:
+			frame = dharma_frame(ctx, self, self.alternatives()[sel])
 
-					while m != None:
-						if not m.group("xref") in path_idents:
-							print m.group("xref") + " is not in path_idents"
-							is_leaf_path = False
+		frame.alt = sel
 
-						suffix = suffix[m.end():]
-						m = re.search("\+(?P<xref>[a-zA-Z0-9_]+)\+", suffix)
+		if ctx.record:
+			frame.out.alt = sel
 
-					if is_leaf_path == False:
-						sval = (sval + 1) % (len(minimized_values)-1)
-					else:
-						break
+		if ctx.coverage != None and sel != None:
+			ctx.coverage.record(self, sel)
 
-				if is_leaf_path == False:
-					print "e: no path to leaf in force-leaf mode in value " + self.ident
-					sys.exit(-1)
+		if ctx.profile != None:
+			ctx.profile.enter(ctx, frame, depth)
 
-				value = minimized_values[sval]
+		ctx.nodes += 1
+		ctx.output_bytes += frame.size
+		ctx.pending_bytes += frame.pending
 
-		else:
-			sval = random.randint(0, len(self.values)-1)
+		return frame
 
-			value = self.values[sval]
+	def generate(self, ctx):
+		return join_fragments(self.derive(ctx))
 
-		value = self.eval_meta(value)
-		value = self.eval_element_xref(value)
-		value = self.eval_value_xref(value)
-		value = self.eval_variable_xref(value)
+	# expand this object using an explicit work stack rather than recursing through generate,
+	# child expansions are linked into their parent fragment list, which is returned unjoined
+	def derive(self, ctx):
+		if ctx.coverage != None:
+			ctx.coverage.parent = None
 
-		return value
+		root = self.expand(ctx, 0)
+		stack = [root]
 
-class dharma_variable(dharma_object):
-	variable_map = {}
+		while len(stack) != 0:
+			frame = stack[-1]
 
-	def __init__(self, ident):
-		dharma_object.__init__(self, ident)
-		self.variables = []
-		self.count = 0
-		self.default = ""
-		return
+			if frame.pos == len(frame.xrefs):
+				stack.pop()
 
-	def clear(self):
-		self.count = 0
-		self.default = ""
+				if ctx.profile != None:
+					ctx.profile.leave(ctx, frame)
 
-	def add_default_variable(self, variable_prefix, variable_suffix):
-		self.variables.append((variable_prefix, variable_suffix))
-		return
+				if frame.variable != None:
+					ctx.defaults[frame.variable] = join_fragments(frame.out)
+					ctx.default_trees[frame.variable] = frame.out
 
-	def new_element(self):
-		self.count = self.count + 1
-		return self.ident + str(self.count)
+				if frame.obj.pooled:
+					frame.obj.add_pooled(ctx, join_fragments(frame.out))
 
-	def generate(self):
-		if self.count > 0:
-			element = random.randint(1, self.count)
-			return self.ident + str(element)
+				continue
 
-		# we have a variable xref before any elements have been contributed, generate a default
-		sel = random.randint(0, len(self.variables)-1)
+			(index, seg_type, obj) = frame.xrefs[frame.pos]
+			frame.pos += 1
 
-		self.count = 1
-		
-		variable = self.variables[sel][0] + self.ident + "1" + self.variables[sel][1]
+			if ctx.coverage != None:
+				ctx.coverage.parent = (frame.obj, frame.alt)
 
-		variable = self.eval_meta(variable)
-		variable = self.eval_value_xref(variable)
-		variable = self.eval_variable_xref(variable)
+			if seg_type == dharma_const.VALUE_SEGMENT:
+				if obj.size != None:
+					ctx.pending_bytes -= obj.size
 
-		self.default = variable
+				# a reused expansion is linked in as a plain string, it has no derivation tree
+				if obj.pooled and obj in ctx.pools and ctx.rng.random() < ctx.const.POOL_REUSE_RATIO:
+					pool = ctx.pools[obj]
+					fragment = pool[ctx.rng.randint(0, len(pool)-1)]
 
-		return self.ident + "1"
-		
-class dharma_variance(dharma_object):
+					ctx.output_bytes += len(fragment)
+					frame.out[index] = fragment
+					continue
 
-	def __init__(self, ident):
-		dharma_object.__init__(self, ident)
-		self.variances = []
-		return
+				child = obj.expand(ctx, len(stack))
 
-	def add_variance(self, variance):
-		self.variances.append(variance)
-		return
+				frame.out[index] = child.out
+				stack.append(child)
+			else:
+				if ctx.counts.get(obj, 0) > 0:
+					frame.out[index] = obj.generate(ctx)
+					continue
 
-	def generate(self):
-		sel = random.randint(0, len(self.variances)-1)
+				# we have a variable xref before any elements have been contributed, generate a default
+				child = obj.expand(ctx, len(stack))
+				child.variable = obj
 
-		base = self.variances[sel]
+				frame.out[index] = obj.ident + "1"
+				stack.append(child)
 
-		base = self.eval_meta(base)
-		base = self.eval_element_xref(base)
-		base = self.eval_value_xref(base)
-		base = self.eval_variable_xref(base)
+		return root.out
 
-		return base
+class dharma_frame:
 
-class dharma_machine:
+	def __init__(self, ctx, obj, segments):
+		self.ctx = ctx
+		self.obj = obj
+		self.xrefs = []
+		self.pos = 0
+		self.variable = None
+		self.size = 0
+		self.pending = 0
+		self.alt = None
 
-	def __init__(self, out, filetype, prefix, suffix, count, tabs):
-		self.section = dharma_const.VOID_SECTION
-		self.level = dharma_const.TOP_LEVEL
-		self.line_number = 0
-		self.current_obj = 0
-		self.value = {}
-		self.variable = {}
-		self.variance = {}
+		if ctx.record:
+			self.out = dharma_node(rule_name(obj))
+		else:
+			self.out = []
 
-		self.out = out.rstrip("/")
-		self.filetype = filetype
-		self.prefix = prefix
-		self.suffix = suffix
-		self.count = count
-		self.tabs = tabs
-	
-	def parse_line(self, line):
-		self.line_number += 1
+		self.values = []
+		self.variables = []
 
-		if self.match_comment(line):
-			return
+		self.add_segments(segments, iter(obj.meta_repeat(ctx, segments)))
 
-		if self.match_const(line):
-			self.parse_const(line)
-			return
+		# all value references of a template are expanded before its variable references
+		self.xrefs = self.values + self.variables
 
-		if self.match_section_assignment(line):
-			self.set_section(line)
-			return
+		return
 
-		if self.match_empty_line(line):
-			if obj_type(self.current_obj) == "dharma_object":
-				print "e: empty assignment (line %d)" % self.line_number
-				sys.exit(-1)
-			elif self.current_obj != 0:
-				self.add_section_object()
+	# %repeat% is a loop node, each repetition is expanded straight into the output
+	def add_segments(self, segments, counts):
+		for seg in segments:
+			seg_type = seg[0]
+
+			if seg_type == dharma_const.LITERAL_SEGMENT:
+				self.out.append(seg[1])
+				self.size += len(seg[1])
+			elif seg_type == dharma_const.VALUE_SEGMENT:
+				if not seg[1] in self.obj.value_xref:
+					raise dharma_error("value xref inconsistency in " + self.obj.ident + " for " + seg[1])
+
+				value = self.obj.value_xref[seg[1]]
+
+				if value.size != None:
+					self.pending += value.size
+
+				self.values.append((len(self.out), seg_type, value))
+				self.out.append("")
+			elif seg_type == dharma_const.VARIABLE_SEGMENT:
+				if not seg[1] in self.obj.variable_xref:
+					raise dharma_error("variable xref inconsistency in " + self.obj.ident + " looking for " + seg[1])
+
+				self.variables.append((len(self.out), seg_type, self.obj.variable_xref[seg[1]]))
+				self.out.append("")
+				self.size += len(seg[1]) + 1
+			elif seg_type == dharma_const.ELEMENT_SEGMENT:
+				if not seg[1] in self.obj.element_xref:
+					raise dharma_error("element xref inconsistency in " + self.obj.ident + " for " + seg[1])
+
+				element = self.obj.element_xref[seg[1]].new_element(self.ctx)
+
+				self.out.append(element)
+				self.size += len(element)
+			elif seg_type == dharma_const.RANGE_SEGMENT:
+				outval = self.obj.meta_range(self.ctx, seg[1])
+
+				self.out.append(outval)
+				self.size += len(outval)
+			else:
+				(repval, sepval) = seg[1]
+				nrep = counts.next()
+				spans = []
 
-			self.level = dharma_const.TOP_LEVEL
-			self.current_obj = 0
-			return
+				for i in range(0, nrep):
+					start = len(self.out)
+					self.add_segments(repval, counts)
+					spans.append((start, len(self.out)))
+					if i != nrep - 1:
+						# the minimum costs under-estimate what ranges and elements lay out
+						if self.budget_spent():
+							break
 
-		if self.section == dharma_const.VOID_SECTION:
-			print "e: non-empty line in void section (line %d)" % self.line_number
-			sys.exit(-1)
+						self.add_segments(sepval, counts)
 
-		if self.level == dharma_const.TOP_LEVEL:
-			self.parse_top_level(line)
-		elif self.level == dharma_const.ASSIGN_LEVEL:
-			self.parse_assign_level(line)
+				if self.ctx.record:
+					self.out.repeats.append(spans)
 
 		return
 
-	def parse_top_level(self, line):
-		if not self.match_top_level(line):
-			print "e: top level syntax error (line %d)" % self.line_number
-			sys.exit(-1)
-
-		m = re.match("^(?P<ident>[a-zA-Z0-9_]+) *:= *\n$", line);
-		ident_str = m.group("ident")
+	# whether this frame together with what the testcase already holds has used up the output
+	# or node budget, so no further repetition is laid out
+	def budget_spent(self):
+		ctx = self.ctx
+		ratio = ctx.const.BUDGET_RATIO
 
-		self.current_obj = dharma_object(ident_str)
+		if ctx.const.MAX_OUTPUT_BYTES > 0:
+			if ctx.output_bytes + ctx.pending_bytes + self.size + self.pending >= ctx.const.MAX_OUTPUT_BYTES * ratio:
+				return True
 
-		self.level = dharma_const.ASSIGN_LEVEL
+		if ctx.const.MAX_EXPANSION_NODES > 0:
+			if ctx.nodes + len(self.values) >= ctx.const.MAX_EXPANSION_NODES * ratio:
+				return True
 
-		return
+		return False
 
-	def parse_assign_level(self, line):
-		if not self.match_assign_level(line):
-			print "e: assign level syntax error (line %d)" % self.line_number
-			sys.exit(-1)
+# a fragment list that remembers the rule and alternative that produced it, and the fragment
+# spans of every %repeat% iteration. nested nodes form the derivation tree of a testcase
+class dharma_node(list):
 
-		assign_str = line[1:]
+	def __init__(self, rule=None):
+		list.__init__(self)
+		self.rule = rule
+		self.alt = None
+		self.repeats = []
 
-		if self.section == dharma_const.VALUE_SECTION:
-			self.parse_assign_value(assign_str)
-		elif self.section == dharma_const.VARIABLE_SECTION:
-			self.parse_assign_variable(assign_str)
-		elif self.section == dharma_const.VARIANCE_SECTION:
-			self.parse_assign_variance(assign_str)
-		else:
-			print "e: invalid state for assignment (line %d)" % self.line_number
-			sys.exit(-1)
+class dharma_value(dharma_object):
 
-		self.parse_value_xref(line)
-		self.parse_variable_xref(line)
-		self.parse_element_xref(line)
+	def __init__(self, ident):
+		dharma_object.__init__(self, ident)
+		self.values = []
+		return
 
+	def add_value(self, value):
+		self.values.append(self.parse_segments(self.parse_weight(value)))
 		return
 
-	def parse_assign_value(self, value):
-		value = value.rstrip("\n")
+	def alternatives(self):
+		return self.values
 
-		tstr = ""
+	def select(self, ctx):
+		if ctx.leaf_mode == False:
+			ctx.leaf_trigger += 1
 
-		for t in range(0, self.tabs):
-			tstr += "\t"
+			if ctx.leaf_trigger > ctx.const.LEAF_TRIGGER:
+				ctx.leaf_mode = True
 
-		value = value.replace("\\n", "\n" + tstr)
+				if ctx.profile != None:
+					ctx.profile.leaf_triggers += 1
 
-		if obj_type(self.current_obj) == "dharma_object":
-			value_obj = dharma_value(self.current_obj.ident)
-			value_obj.add_value(value)
-			self.current_obj = value_obj
-		elif obj_type(self.current_obj) == "dharma_value":
-			self.current_obj.add_value(value)
+		if len(self.values) == 0:
+			return None
+		elif ctx.leaf_mode == True:
+			# pick one of the alternatives that terminate in the fewest expansion steps
+			if self.leaf_alias != None:
+				return self.leaf[alias_sample(self.leaf_alias, ctx.rng)]
+
+			sval = ctx.rng.randint(0, len(self.leaf)-1)
+
+			return self.leaf[sval]
+		elif ctx.coverage != None:
+			return ctx.coverage.choose(self, len(self.values), ctx)
+		elif self.alias != None:
+			return alias_sample(self.alias, ctx.rng)
 		else:
-			print "e: normal value found in non-normal assignment (line %d)" % self.line_number
-			sys.exit(-1)
+			return ctx.rng.randint(0, len(self.values)-1)
 
-		return
+# element counts and defaults of a variable are per testcase and live in the dharma_context
+class dharma_variable(dharma_object):
 
-	# search token for +value+ style references
-	def parse_value_xref(self, token):
-		m = re.search("\+(?P<xref>[a-zA-Z0-9_]+)\+", token)
+	def __init__(self, ident):
+		dharma_object.__init__(self, ident)
+		self.variables = []
+		return
 
-		if not m:	
-			return
+	def add_default_variable(self, variable_prefix, variable_suffix):
+		variable = variable_prefix + self.ident + "1" + variable_suffix
+		self.variables.append(self.parse_segments(variable, False))
+		return
 
-		xref = m.group("xref")
-		self.current_obj.add_value_xref(xref)
+	def new_element(self, ctx):
+		ctx.counts[self] = ctx.counts.get(self, 0) + 1
+		return self.ident + str(ctx.counts[self])
 
-		next_token = token.find("+" + xref + "+") + len(xref) + 2
-		self.parse_value_xref(token[next_token:])
+	def generate(self, ctx):
+		element = ctx.rng.randint(1, ctx.counts[self])
+		return self.ident + str(element)
 
-		return
+	def alternatives(self):
+		return self.variables
 
-	# search token for !variable! style references (be careful to not xref a new variable)
-	def parse_variable_xref(self, token):
-		regex = "\!(?P<xref>[a-zA-Z0-9_]+)\!"
+	def select(self, ctx):
+		sel = ctx.rng.randint(0, len(self.variables)-1)
 
-		m = re.search(regex, token)
+		ctx.counts[self] = 1
 
-		if not m:
-			return
+		return sel
 
-		xref = m.group("xref")
-		self.current_obj.add_variable_xref(xref)
+class dharma_variance(dharma_object):
 
-		next_token = token.find("!" + xref + "!") + len(xref) + 2
-		self.parse_variable_xref(token[next_token:])
+	def __init__(self, ident):
+		dharma_object.__init__(self, ident)
+		self.variances = []
+		return
 
+	def add_variance(self, variance):
+		self.variances.append(self.parse_segments(self.parse_weight(variance)))
 		return
 
-	def parse_element_xref(self, token):
-		m = re.search("\@(?P<xref>[a-zA-Z0-0_]+)\@", token)
+	def alternatives(self):
+		return self.variances
+
+	def select(self, ctx):
+		if ctx.coverage != None:
+			return ctx.coverage.choose(self, len(self.variances), ctx)
+
+		if self.alias != None:
+			return alias_sample(self.alias, ctx.rng)
+
+		return ctx.rng.randint(0, len(self.variances)-1)
+
+# per-alternative expansion count, inclusive and self time and bytes and deepest expansion, plus
+# how often leaf mode and budget convergence kicked in. rules are keyed as "<section>:<ident>"
+class dharma_profile:
+	COUNT = 0
+	TIME = 1
+	BYTES = 2
+	DEPTH = 3
+	SELF_TIME = 4
+	SELF_BYTES = 5
+
+	def __init__(self, path):
+		self.path = path
+		self.rules = {}
+		self.testcases = 0
+		self.leaf_triggers = 0
+		self.converges = 0
+		self.merged = []
+		self.frames = []
+		self.active = {}
+
+	# a testcase given up halfway through leaves frames behind that are never left
+	def start_testcase(self):
+		self.testcases += 1
+		del self.frames[:]
+		self.active.clear()
 
-		if not m:
-			return
+		return
 
-		xref = m.group("xref")
+	def enter(self, ctx, frame, depth):
+		if not frame.obj in self.rules:
+			self.rules[frame.obj] = [[0, 0.0, 0, 0, 0.0, 0] for alt in frame.obj.alternatives()]
 
-		self.current_obj.add_element_xref(xref)
+		frame.depth = depth
+		frame.start_bytes = ctx.output_bytes
+		frame.child_bytes = 0
+		frame.child_time = 0.0
+		frame.start_time = timeit.default_timer()
 
-		next_token = token[m.end():]
-		self.parse_element_xref(next_token)
+		self.frames.append(frame)
+		self.active[frame.obj] = self.active.get(frame.obj, 0) + 1
 
 		return
 
-	def parse_assign_variable(self, variable_line):
-		if not self.match_assign_variable(variable_line):
-			print "e: variable assignment syntax error (line %d)" % self.line_number
-			sys.exit(-1)
+	# inclusive totals are only taken at the outermost active expansion of a rule, otherwise a
+	# recursive rule would count the same time and bytes once for every level it nests
+	def leave(self, ctx, frame):
+		elapsed = timeit.default_timer() - frame.start_time
+		produced = ctx.output_bytes - frame.start_bytes
 
-		tstr = ""
+		self.frames.pop()
+		self.active[frame.obj] -= 1
 
-		for t in range(0, self.tabs):
-			tstr += "\t"
+		if len(self.frames) != 0:
+			parent = self.frames[-1]
+			parent.child_time += elapsed
+			parent.child_bytes += produced
 
-		variable_line = variable_line.replace("\\n", "\n" + tstr)
-		
-		m = re.search("\@(?P<variable>[a-zA-Z0-9_]+)\@", variable_line)
+		if frame.alt == None:
+			return
 
-		variable = m.group("variable")
+		stats = self.rules[frame.obj][frame.alt]
+		stats[dharma_profile.COUNT] += 1
+		stats[dharma_profile.SELF_TIME] += elapsed - frame.child_time
+		stats[dharma_profile.SELF_BYTES] += produced - frame.child_bytes
 
-		if variable != self.current_obj.ident:
-			print "e: variable name mismatch (line %d)" % self.line_number
-			sys.exit(-1)
+		if self.active[frame.obj] == 0:
+			stats[dharma_profile.TIME] += elapsed
+			stats[dharma_profile.BYTES] += produced
 
-		prefix_end = m.start("variable") - 1
-		suffix_start = m.end("variable") + 1
+		if frame.depth > stats[dharma_profile.DEPTH]:
+			stats[dharma_profile.DEPTH] = frame.depth
 
-		prefix = variable_line[:prefix_end]
-		suffix = variable_line[suffix_start:].rstrip("\n")
+		return
 
-		if obj_type(self.current_obj) == "dharma_object":
-			variable_obj = dharma_variable(self.current_obj.ident)
-			variable_obj.add_default_variable(prefix, suffix)
-			self.current_obj = variable_obj
-		elif obj_type(self.current_obj) == "dharma_variable":
-			self.current_obj.add_default_variable(prefix, suffix)
-		else:
-			print "e: inconsistent object for variable assignment (line %d)" % self.line_number
-			sys.exit(-1)
+	def report(self):
+		rules = {}
+
+		for (obj, alternatives) in self.rules.items():
+			rules[rule_name(obj)] = alternatives
 
+		return {
+			"testcases": self.testcases,
+			"leaf_triggers": self.leaf_triggers,
+			"converges": self.converges,
+			"rules": rules,
+		}
+
+	# counterpart of dharma_coverage.mark. workers are forked before anything is profiled, so
+	# their statistics are already only their own
+	def mark(self):
 		return
 
-	def parse_assign_variance(self, variance_line):
-		variance_line = variance_line.rstrip("\n")
+	# parallel workers hand their raw report to the parent through a file
+	def save_report(self, path):
+		fd = open(path, 'w')
+		json.dump(self.report(), fd)
+		fd.close()
 
-		tstr = ""
+		return
 
-		for t in range(0, self.tabs):
-			tstr += "\t"
+	def merge_report(self, path):
+		try:
+			fd = open(path, 'r')
+			self.merged.append(json.load(fd))
+			fd.close()
+		except (IOError, ValueError):
+			pass
 
-		variance_line = variance_line.replace("\\n", "\n" + tstr)
+		return
 
-		if obj_type(self.current_obj) == "dharma_object":
-			variance_obj = dharma_variance(self.current_obj.ident)
-			variance_obj.add_variance(variance_line)
-			self.current_obj = variance_obj
-		elif obj_type(self.current_obj) == "dharma_variance":
-			self.current_obj.add_variance(variance_line)
-		else:
-			print "e: inconsistent object for variance assignment (line %d)" % self.line_number
-			sys.exit(-1)
+	def dump(self, path=None):
+		if path == None:
+			path = self.path
+
+		report = self.report()
+
+		for other in self.merged:
+			report["testcases"] += other["testcases"]
+			report["leaf_triggers"] += other["leaf_triggers"]
+			report["converges"] += other["converges"]
+
+			for (name, alternatives) in other["rules"].items():
+				if not name in report["rules"]:
+					report["rules"][name] = alternatives
+					continue
+
+				for (stats, other_stats) in zip(report["rules"][name], alternatives):
+					stats[dharma_profile.COUNT] += other_stats[dharma_profile.COUNT]
+					stats[dharma_profile.TIME] += other_stats[dharma_profile.TIME]
+					stats[dharma_profile.BYTES] += other_stats[dharma_profile.BYTES]
+					stats[dharma_profile.DEPTH] = max(stats[dharma_profile.DEPTH], other_stats[dharma_profile.DEPTH])
+					stats[dharma_profile.SELF_TIME] += other_stats[dharma_profile.SELF_TIME]
+					stats[dharma_profile.SELF_BYTES] += other_stats[dharma_profile.SELF_BYTES]
+
+		rules = {}
+
+		for (name, alternatives) in report["rules"].items():
+			rules[name] = {
+				"expansions": sum(stats[dharma_profile.COUNT] for stats in alternatives),
+				"time": sum(stats[dharma_profile.TIME] for stats in alternatives),
+				"bytes": sum(stats[dharma_profile.BYTES] for stats in alternatives),
+				"self_time": sum(stats[dharma_profile.SELF_TIME] for stats in alternatives),
+				"self_bytes": sum(stats[dharma_profile.SELF_BYTES] for stats in alternatives),
+				"max_depth": max(stats[dharma_profile.DEPTH] for stats in alternatives),
+				"alternatives": [{
+					"expansions": stats[dharma_profile.COUNT],
+					"time": stats[dharma_profile.TIME],
+					"bytes": stats[dharma_profile.BYTES],
+					"self_time": stats[dharma_profile.SELF_TIME],
+					"self_bytes": stats[dharma_profile.SELF_BYTES],
+					"max_depth": stats[dharma_profile.DEPTH],
+				} for stats in alternatives],
+			}
+
+		report["rules"] = rules
+
+		try:
+			fd = open(path, 'w')
+			json.dump(report, fd, indent=1, sort_keys=True)
+			fd.close()
+		except IOError, err:
+			raise dharma_error("error writing profile " + path + ": " + str(err))
 
 		return
 
-	def add_section_object(self):
-		if self.section == dharma_const.VALUE_SECTION:
-			if self.current_obj.ident in self.value:
-				print "e: redefining value (line %d)" % self.line_number
-				sys.exit(-1)
+# counts how often every alternative and every (parent alternative, alternative) pair has been
+# emitted, and weights selection toward the rarely seen ones. the counts persist across runs
+class dharma_coverage:
 
-			self.value[self.current_obj.ident] = self.current_obj
-		elif self.section == dharma_const.VARIABLE_SECTION:
-			if self.current_obj.ident in self.variable:
-				print "e: redefining variable (line %d)" % self.line_number
-				sys.exit(-1)
+	def __init__(self, path, machine):
+		self.path = path
+		self.rules = {}
+		self.alternatives = {}
+		self.pairs = set()
+		self.parent = None
+		self.base = {}
 
-			self.variable[self.current_obj.ident] = self.current_obj
-		elif self.section == dharma_const.VARIANCE_SECTION:
-			if self.current_obj.ident in self.variance:
-				print "e: redefining variance (line %d)" % self.line_number
-				sys.exit(-1)
-			
-			self.variance[self.current_obj.ident] = self.current_obj
-		else:
-			print "e: inconsistent section value, fatal"
-			sys.exit(-1)
-		return
+		for objects in (machine.value, machine.variable, machine.variance):
+			for obj in objects.values():
+				self.rules[rule_name(obj)] = obj
 
-	def parse_const(self, line):
-		m = re.match("^%const% *(?P<const>[A-Z_]+) *:= *(?P<val>.*)\n$", line)
+		if os.path.exists(path):
+			self.merge_report(path)
 
-		const = m.group("const")
-		val = m.group("val")
+	def counts(self, obj):
+		if not obj in self.alternatives:
+			self.alternatives[obj] = [0] * len(obj.alternatives())
 
-		if not const in dharma_const.__dict__:
-			print "e: trying to set non-existent constant (line %d)" % self.line_number
-			sys.exit(-1)
+		return self.alternatives[obj]
 
-		if val[0] == "\"":
-			val = val[1:len(val)-1]
-			setattr(dharma_const, const, val)
-		elif val.find(".") != -1:
-			setattr(dharma_const, const, float(val))
-		else:
-			setattr(dharma_const, const, int(val))
+	def record(self, obj, sel):
+		self.counts(obj)[sel] += 1
 
-	def match_comment(self, line):
-		return re.match("^%%%.*\n$", line)
+		if self.parent != None:
+			self.pairs.add((self.parent[0], self.parent[1], obj, sel))
 
-	def match_const(self, line):
-		return re.match("^%const% *[A-Z_]+ *:=.*\n$", line)
+		return
 
-	def match_section_assignment(self, line):
-		return re.match("^%section% *:= *(value|variable|variance)\n$", line, re.I)
+	def choose(self, obj, count, ctx):
+		counts = self.counts(obj)
+		parent = self.parent
+		total = 0.0
+		weights = []
 
-	def match_empty_line(self, line):
-		return re.match("^(\n| *\n|\t*\n)$", line)
+		for alt in range(0, count):
+			weight = 1.0 / (1 + counts[alt])
 
-	def match_top_level(self, line):
-		return re.match("^[a-zA-Z0-9_]+ *:= *\n$", line)
+			if obj.alias != None:
+				weight *= obj.weights[alt]
 
-	def match_assign_level(self, line):
-		return re.match("^\t", line)
+			if parent != None and not (parent[0], parent[1], obj, alt) in self.pairs:
+				weight *= ctx.const.COVERAGE_PAIR_BONUS
 
-	def match_value_range(self, value_line):
-		return re.match("^(-|)[0-9]+(\.[0-9]+|)-[0-9]+(\.[0-9]+|)\n$", value_line)
+			total += weight
+			weights.append(total)
 
-	def match_value_repeater(self, value_line):
-		return re.search("\.\.\.", value_line)
+		return min(bisect.bisect_right(weights, ctx.rng.uniform(0, total)), count-1)
 
-	def match_assign_variable(self, variable_line):
-		return re.search("\@[a-zA-Z0-9_]+\@", variable_line)
+	# a parallel worker only reports the counts added after it was forked
+	def mark(self):
+		self.base = dict((obj, list(counts)) for (obj, counts) in self.alternatives.items())
 
-	def set_section(self, line):
-		m = re.match("^%section% *:= *(?P<section_mode>\w+)\n$", line, re.I)
-		new_section_str = m.group('section_mode').upper() + "_SECTION"
-		new_section = getattr(dharma_const, new_section_str)
-		self.section = new_section
 		return
 
-	def resolve_xref(self):
-		self.resolve_section_xref(self.value)
-		self.resolve_section_xref(self.variable)
-		self.resolve_section_xref(self.variance)
+	def report(self):
+		alternatives = {}
 
-		return
+		for (obj, counts) in self.alternatives.items():
+			if obj in self.base:
+				counts = [n - base for (n, base) in zip(counts, self.base[obj])]
 
-	def resolve_section_xref(self, section):
-		for v in section:
-			obj = section[v]
-			self.resolve_object_xref(obj)
+			alternatives[rule_name(obj)] = counts
 
-		return
+		pairs = [(rule_name(pobj), palt, rule_name(obj), alt) for (pobj, palt, obj, alt) in self.pairs]
 
-	def resolve_object_xref(self, obj):
-		for x in obj.value_xref:
-			if not x in self.value:
-				print "e: undefined value reference from " + obj.ident + " to " + x
-				sys.exit(-1)
+		return {
+			"alternatives": alternatives,
+			"pairs": pairs,
+		}
 
-			obj.value_xref[x] = self.value[x]
+	def summary(self):
+		total = 0
+		covered = 0
 
-		for x in obj.variable_xref:
-			if not x in self.variable:
-				print "e: undefined variable reference from " + obj.ident + " to " + x
-				sys.exit(-1)
+		for obj in self.rules.values():
+			counts = self.counts(obj)
 
-			obj.variable_xref[x] = self.variable[x]
+			total += len(counts)
+			covered += len(counts) - counts.count(0)
 
-		for x in obj.element_xref:
-			if not x in self.variable:
-				print "e: element reference without a default variable from " + obj.ident + " to " + x
-				sys.exit(-1)
+		return (covered, total, len(self.pairs))
 
-			obj.element_xref[x] = self.variable[x]
+	def save_report(self, path):
+		fd = open(path, 'w')
+		json.dump(self.report(), fd)
+		fd.close()
 
 		return
 
-	def calculate_leaf_paths(self):
-		self.leaf_seen = []
-		self.reverse_xref = {}
-
-		# build map of reverse xrefs
-		for val in self.value:
-			valobj = self.value[val]
+	# fold in a saved state or the report of a parallel worker. rules and alternatives that no
+	# longer exist in the grammar are dropped
+	def merge_report(self, path):
+		try:
+			fd = open(path, 'r')
+			report = json.load(fd)
+			fd.close()
+		except (IOError, ValueError):
+			return
 
-			for xref in valobj.value_xref:
-				if not xref in self.reverse_xref:
-					self.reverse_xref[xref] = list()
+		for (name, counts) in report["alternatives"].items():
+			if not name in self.rules:
+				continue
 
-				self.reverse_xref[xref].append(valobj.ident)
+			own = self.counts(self.rules[name])
 
-		# for all leafs, traverse backwards marking path to leaf
-		for val in self.value:
-			valobj = self.value[val]
+			for alt in range(0, min(len(own), len(counts))):
+				own[alt] += counts[alt]
 
-			if valobj in self.leaf_seen:
+		for (pname, palt, name, alt) in report["pairs"]:
+			if not pname in self.rules or not name in self.rules:
 				continue
 
-			if len(valobj.leaf) == 0:
-				continue
+			(pobj, obj) = (self.rules[pname], self.rules[name])
 
-			self.calculate_leaf_path(valobj)
+			if palt < len(pobj.alternatives()) and alt < len(obj.alternatives()):
+				self.pairs.add((pobj, palt, obj, alt))
 
-	def calculate_leaf_path(self, leafobj):
-		self.leaf_seen.append(leafobj)
+		return
 
-		if not leafobj.ident in self.reverse_xref:
-			return
+	def dump(self):
+		try:
+			self.save_report(self.path)
+		except IOError, err:
+			raise dharma_error("error writing coverage state " + self.path + ": " + str(err))
 
-		for xref in self.reverse_xref[leafobj.ident]:
-			xrefobj = self.value[xref]
+		return
 
-			xrefobj.add_leaf_path(leafobj.ident, leafobj.ident, 0)
+# static analysis of a resolved grammar. rules are checked for reachability from the variances
+# and for termination, and the mean and variance of their output length are estimated for free
+# expansion with the grammar's alternative weights. the estimates are the least fixed point of
+# the moment equations, a rule whose mean does not converge has unbounded expected size
+class dharma_analysis:
+
+	def __init__(self, machine):
+		self.machine = machine
+		self.const = dharma_consts(machine.consts)
+		self.objs = machine.value.values() + machine.variable.values() + machine.variance.values()
+		self.repeat = repeat_moments(self.const.MAX_REPEAT_POWER)
+		self.reachable = machine.reachable()
+		self.estimates = self.estimate()
+
+	# (mean, variance, value selections) of the output length of a template
+	def segment_moments(self, obj, segments, estimates):
+		(mean, var, nodes) = (0.0, 0.0, 0.0)
+
+		for seg in segments:
+			seg_type = seg[0]
+
+			if seg_type == dharma_const.LITERAL_SEGMENT:
+				mean += len(seg[1])
+			elif seg_type == dharma_const.VALUE_SEGMENT:
+				(ref_mean, ref_var, ref_nodes) = estimates[obj.value_xref[seg[1]]]
+
+				mean += ref_mean
+				var += ref_var
+				nodes += ref_nodes
+			elif seg_type == dharma_const.VARIABLE_SEGMENT or seg_type == dharma_const.ELEMENT_SEGMENT:
+				mean += len(seg[1]) + 1
+			elif seg_type == dharma_const.RANGE_SEGMENT:
+				(range_mean, range_var) = range_moments(seg[1])
+
+				mean += range_mean
+				var += range_var
+			else:
+				# a random number of bodies with one separator less, both scale with the count
+				(body_mean, body_var, body_nodes) = self.segment_moments(obj, seg[1][0], estimates)
+				(sep_mean, sep_var, sep_nodes) = self.segment_moments(obj, seg[1][1], estimates)
+				(count_mean, count_var) = self.repeat
 
-			node_seen = [xrefobj]
-			self.propogate_leaf(leafobj.ident, xrefobj, node_seen, 1)
+				mean += count_mean * body_mean + (count_mean - 1) * sep_mean
+				var += count_mean * body_var + (count_mean - 1) * sep_var + count_var * (body_mean + sep_mean) ** 2
+				nodes += count_mean * body_nodes + (count_mean - 1) * sep_nodes
 
-	def propogate_leaf(self, leaf, obj, node_seen, depth):
-		if not obj.ident in self.reverse_xref:
+		return (mean, var, nodes)
+
+	def rule_moments(self, obj, estimates):
+		alternatives = obj.alternatives()
+		weights = obj.weights
+
+		if len(weights) != len(alternatives):
+			weights = [1.0] * len(alternatives)
+
+		total = sum(weights)
+		(mean, square, nodes) = (0.0, 0.0, 0.0)
+
+		for (segments, weight) in zip(alternatives, weights):
+			if weight == 0:
+				continue
+
+			(alt_mean, alt_var, alt_nodes) = self.segment_moments(obj, segments, estimates)
+			p = weight / total
+
+			mean += p * alt_mean
+			square += p * (alt_var + alt_mean ** 2)
+			nodes += p * alt_nodes
+
+		# only dharma_value selections count toward LEAF_TRIGGER
+		if isinstance(obj, dharma_value):
+			nodes += 1
+
+		if mean == float("inf"):
+			return (mean, mean, nodes)
+
+		return (mean, max(0.0, square - mean ** 2), nodes)
+
+	# strongly connected components of the value reference graph (tarjan's algorithm, with an
+	# explicit stack for deep grammars). components come out with every rule they reference first
+	def components(self):
+		index = {}
+		low = {}
+		stack = []
+		on_stack = set()
+		components = []
+
+		for root in self.objs:
+			if root in index:
+				continue
+
+			work = [(root, iter(set(root.value_xref.values())))]
+			index[root] = low[root] = len(index)
+			stack.append(root)
+			on_stack.add(root)
+
+			while len(work) != 0:
+				(obj, refs) = work[-1]
+				descended = False
+
+				for ref in refs:
+					if not ref in index:
+						index[ref] = low[ref] = len(index)
+						stack.append(ref)
+						on_stack.add(ref)
+						work.append((ref, iter(set(ref.value_xref.values()))))
+						descended = True
+						break
+					elif ref in on_stack:
+						low[obj] = min(low[obj], index[ref])
+
+				if descended:
+					continue
+
+				work.pop()
+
+				if len(work) != 0:
+					parent = work[-1][0]
+					low[parent] = min(low[parent], low[obj])
+
+				if low[obj] != index[obj]:
+					continue
+
+				component = []
+
+				while True:
+					member = stack.pop()
+					on_stack.remove(member)
+					component.append(member)
+
+					if member == obj:
+						break
+
+				components.append(component)
+
+		return components
+
+	# rules are solved one component at a time, so a rule outside any cycle takes a single pass
+	# and only the rules of a cycle are iterated toward their fixed point
+	def estimate(self):
+		inf = float("inf")
+		estimates = {}
+
+		for component in self.components():
+			cyclic = len(component) > 1 or component[0] in component[0].value_xref.values()
+
+			for obj in component:
+				estimates[obj] = (0.0, 0.0, 0.0)
+
+			if not cyclic:
+				estimates[component[0]] = self.bounded(self.rule_moments(component[0], estimates))
+				continue
+
+			changing = set(component)
+
+			for iteration in range(0, self.const.ANALYSIS_ITERATIONS):
+				changed = set()
+
+				for obj in component:
+					old = estimates[obj]
+					new = self.bounded(self.rule_moments(obj, estimates))
+
+					for (a, b) in zip(old, new):
+						if a != b and abs(a - b) > self.const.ANALYSIS_TOLERANCE * max(1.0, abs(b)):
+							changed.add(obj)
+
+					estimates[obj] = new
+
+				changing = changed
+
+				if len(changing) == 0:
+					break
+
+			# still growing after the last iteration, treat as diverging
+			for obj in changing:
+				estimates[obj] = (inf, inf, inf)
+
+		return estimates
+
+	def bounded(self, moments):
+		if moments[0] > self.const.ANALYSIS_LIMIT or moments[2] > self.const.ANALYSIS_LIMIT:
+			return (float("inf"), float("inf"), float("inf"))
+
+		return moments
+
+	def tail(self, mean, var):
+		# cantelli's inequality bounds the share of outputs above mean + k * sd by 1 / (1 + k^2)
+		return mean + math.sqrt(var * (1.0 / self.const.ANALYSIS_TAIL - 1))
+
+	def testcase(self):
+		variances = self.machine.variance.values()
+
+		if len(variances) == 0:
+			return (0.0, 0.0)
+
+		line = len("\t" * self.machine.tabs + self.const.VARIANCE_PREFIX + self.const.VARIANCE_SUFFIX + "\n")
+		line_mean = line + sum(self.estimates[obj][0] for obj in variances) / len(variances)
+		line_square = sum(self.estimates[obj][1] + (line + self.estimates[obj][0]) ** 2 for obj in variances) / len(variances)
+
+		if line_mean == float("inf"):
+			return (line_mean, line_mean)
+
+		(count_mean, count_var) = uniform_moments(self.const.VARIANCE_MIN, self.const.VARIANCE_MAX)
+		line_var = max(0.0, line_square - line_mean ** 2)
+
+		return (count_mean * line_mean, count_mean * line_var + count_var * line_mean ** 2)
+
+	def report(self):
+		rules = {}
+
+		for obj in self.objs:
+			(mean, var, nodes) = self.estimates[obj]
+			bounded = mean != float("inf")
+
+			rules[rule_name(obj)] = {
+				"reachable": obj in self.reachable,
+				"terminates": obj.depth != None,
+				"non_terminating_alternatives": len([cost for cost in obj.cost if cost == None]),
+				"min_depth": obj.depth,
+				"min_size": obj.size,
+				"bounded": bounded,
+				"expected_size": mean if bounded else None,
+				"tail_size": self.tail(mean, var) if bounded else None,
+				"expected_selections": nodes if bounded else None,
+				"leaf_trigger": not bounded or nodes > self.const.LEAF_TRIGGER,
+			}
+
+		(mean, var) = self.testcase()
+		bounded = mean != float("inf")
+
+		return {
+			"constants": {
+				"MAX_REPEAT_POWER": self.const.MAX_REPEAT_POWER,
+				"LEAF_TRIGGER": self.const.LEAF_TRIGGER,
+				"VARIANCE_MIN": self.const.VARIANCE_MIN,
+				"VARIANCE_MAX": self.const.VARIANCE_MAX,
+			},
+			"tail": self.const.ANALYSIS_TAIL,
+			"testcase": {
+				"bounded": bounded,
+				"expected_size": mean if bounded else None,
+				"tail_size": self.tail(mean, var) if bounded else None,
+			},
+			"rules": rules,
+		}
+
+	def dump(self, path):
+		try:
+			fd = open(path, 'w')
+			json.dump(self.report(), fd, indent=1, sort_keys=True)
+			fd.close()
+		except IOError, err:
+			raise dharma_error("error writing analysis " + path + ": " + str(err))
+
+		return
+
+# bloom filter over testcase fingerprints. the bits and counters live in shared memory so
+# forked workers suppress duplicates across the whole run
+class dharma_dedup:
+
+	def __init__(self, path=None, const=dharma_const):
+		self.path = path
+		self.bits = const.DEDUP_BITS
+		self.hashes = const.DEDUP_HASHES
+
+		data = None
+
+		if path != None and os.path.exists(path):
+			try:
+				fd = open(path, 'rb')
+				header = fd.read(struct.calcsize(dharma_const.DEDUP_HEADER_FORMAT))
+				(magic, self.bits, self.hashes) = struct.unpack(dharma_const.DEDUP_HEADER_FORMAT, header)
+				data = fd.read()
+				fd.close()
+			except (IOError, struct.error), err:
+				raise dharma_error("error reading dedup state " + path + ": " + str(err))
+
+			if magic != dharma_const.DEDUP_MAGIC or len(data) != (self.bits + 7) / 8:
+				raise dharma_error("malformed dedup state " + path)
+
+		self.filter = multiprocessing.RawArray(ctypes.c_ubyte, (self.bits + 7) / 8)
+		self.lock = multiprocessing.Lock()
+
+		# testcases checked, duplicates found and testcases skipped after running out of retries
+		self.stats = multiprocessing.RawArray(ctypes.c_ulonglong, 3)
+
+		if data != None:
+			ctypes.memmove(self.filter, data, len(data))
+
+	# add the fingerprint of a testcase, returns False when it was (probably) seen before
+	def add(self, content):
+		(h1, h2) = struct.unpack("!QQ", hashlib.sha1(content).digest()[:16])
+		positions = [(h1 + i * h2) % self.bits for i in range(0, self.hashes)]
+
+		self.lock.acquire()
+
+		try:
+			self.stats[0] += 1
+
+			seen = True
+
+			for pos in positions:
+				if not self.filter[pos >> 3] & (1 << (pos & 7)):
+					seen = False
+					self.filter[pos >> 3] |= 1 << (pos & 7)
+
+			if seen:
+				self.stats[1] += 1
+		finally:
+			self.lock.release()
+
+		return not seen
+
+	def skip(self):
+		self.lock.acquire()
+		self.stats[2] += 1
+		self.lock.release()
+
+		return
+
+	def summary(self):
+		return (self.stats[1], self.stats[0], self.stats[2])
+
+	def dump(self):
+		if self.path == None:
+			return
+
+		try:
+			(tfd, tmp_file) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+			ofd = os.fdopen(tfd, 'wb')
+			ofd.write(struct.pack(dharma_const.DEDUP_HEADER_FORMAT, dharma_const.DEDUP_MAGIC, self.bits, self.hashes))
+			ofd.write(buffer(self.filter)[:])
+			ofd.close()
+			os.rename(tmp_file, self.path)
+		except (IOError, OSError), err:
+			raise dharma_error("error writing dedup state " + self.path + ": " + str(err))
+
+		return
+
+# write output files from a background thread, so disk i/o overlaps with generation. every file
+# is written in one go under a temporary name and renamed into place, consumers never see a
+# partial file. the queue is bounded so generation cannot run far ahead of the disk
+class dharma_writer:
+
+	def __init__(self, const=dharma_const):
+		self.queue = Queue.Queue(const.WRITER_QUEUE)
+		self.error = None
+		self.dirs = set()
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def run(self):
+		while True:
+			item = self.queue.get()
+
+			if item == None:
+				self.queue.task_done()
+				return
+
+			# after an error the queue is still drained so write and close never block
+			if self.error == None:
+				(path, data) = item
+
+				try:
+					self.write_file(path, data)
+				except (IOError, OSError), err:
+					self.error = "error writing output file " + path + ": " + str(err)
+
+			self.queue.task_done()
+
+	def write_file(self, path, data):
+		out_dir = os.path.dirname(path)
+
+		if not out_dir in self.dirs:
+			if not os.path.isdir(out_dir):
+				try:
+					os.makedirs(out_dir)
+				except OSError, err:
+					# another job created it first
+					if err.errno != errno.EEXIST:
+						raise
+
+			self.dirs.add(out_dir)
+
+		tmp_file = os.path.join(out_dir, "." + os.path.basename(path) + ".tmp")
+
+		ofd = open(tmp_file, 'wb')
+		ofd.write(data)
+		ofd.close()
+		os.rename(tmp_file, path)
+
+		return
+
+	def write(self, path, data):
+		if self.error != None:
+			raise dharma_error(self.error)
+
+		self.queue.put((path, data))
+
+		return
+
+	# wait until every queued file is in place
+	def flush(self):
+		self.queue.join()
+
+		if self.error != None:
+			raise dharma_error(self.error)
+
+		return
+
+	def close(self):
+		self.queue.put(None)
+		self.thread.join()
+
+		if self.error != None:
+			raise dharma_error(self.error)
+
+		return
+
+# count the testcases waiting in the output directory and block until a consumer takes one.
+# removals are watched with inotify where libc has it, otherwise the directory is polled
+class dharma_watcher:
+
+	def __init__(self, out_dir, filetype, const=dharma_const):
+		self.out_dir = out_dir
+		self.extension = "." + filetype
+		self.const = const
+		self.fd = None
+
+		libc = ctypes.CDLL(None, use_errno=True)
+
+		if not hasattr(libc, "inotify_init") or not hasattr(libc, "inotify_add_watch"):
+			return
+
+		fd = libc.inotify_init()
+
+		if fd < 0:
+			return
+
+		if libc.inotify_add_watch(fd, out_dir, dharma_const.INOTIFY_DELETE | dharma_const.INOTIFY_MOVED_FROM) < 0:
+			os.close(fd)
+			return
+
+		self.fd = fd
+
+		return
+
+	def testcases(self):
+		try:
+			names = os.listdir(self.out_dir)
+		except OSError, err:
+			raise dharma_error("error listing output directory: " + str(err))
+
+		return [name for name in names if name.endswith(self.extension) and not name.startswith(".")]
+
+	def pending(self):
+		return len(self.testcases())
+
+	# continue after the highest numbered testcase still waiting, so none is overwritten
+	def next_number(self):
+		numbers = [0]
+
+		for name in self.testcases():
+			number = name[:len(name)-len(self.extension)]
+
+			if number.isdigit():
+				numbers.append(int(number))
+
+		return max(numbers) + 1
+
+	# the poll interval also bounds the wait with inotify, in case an event was missed
+	def wait(self):
+		if self.fd == None:
+			time.sleep(self.const.WATCH_POLL_INTERVAL)
+			return
+
+		try:
+			(readable, writable, failed) = select.select([self.fd], [], [], self.const.WATCH_POLL_INTERVAL)
+
+			if len(readable) != 0:
+				os.read(self.fd, self.const.WATCH_EVENT_BUFFER)
+		except (OSError, select.error), err:
+			if err.args[0] != errno.EINTR:
+				raise dharma_error("error watching output directory: " + str(err))
+
+		return
+
+	def close(self):
+		if self.fd != None:
+			os.close(self.fd)
+			self.fd = None
+
+		return
+
+# shrink a recorded testcase on its derivation tree. subtrees are replaced by the shortest
+# expansion of their rule and %repeat% iterations are cut, keeping each change after which the
+# predicate command still exits with status 0
+class dharma_reducer:
+
+	def __init__(self, machine, tree_file, predicate):
+		(self.tree, self.prefix, self.suffix) = load_tree(tree_file)[:3]
+		self.predicate = predicate
+		self.minimal = machine.minimal_expansions()
+		self.replaced = {}
+		self.kept = {}
+		self.results = {}
+		self.runs = 0
+
+		testcase = tree_file[:len(tree_file)-len(dharma_const.TREE_EXTENSION)]
+		self.extension = os.path.splitext(testcase)[1]
+		self.best = self.render()
+
+	# fragment ranges of a node that are left out by the cut %repeat% iterations, as start: end
+	def dropped(self, node):
+		dropped = {}
+
+		for r in range(0, len(node.repeats)):
+			if not (id(node), r) in self.kept:
+				continue
+
+			spans = node.repeats[r]
+			kept = self.kept[(id(node), r)]
+
+			for j in range(0, len(spans)):
+				if j in kept:
+					continue
+
+				# iterations before the first kept one go with the separator that follows them,
+				# later ones with the separator that precedes them
+				if j < kept[0]:
+					(start, end) = (spans[j][0], spans[j+1][0])
+				else:
+					(start, end) = (spans[j-1][1], spans[j][1])
+
+				dropped[start] = max(end, dropped.get(start, end))
+
+		return dropped
+
+	def render(self):
+		out = []
+		stack = [(self.tree, 0, self.dropped(self.tree))]
+
+		while len(stack) != 0:
+			(node, pos, dropped) = stack.pop()
+
+			while pos < len(node):
+				if pos in dropped:
+					pos = dropped[pos]
+					continue
+
+				fragment = node[pos]
+				pos += 1
+
+				if not isinstance(fragment, list):
+					out.append(fragment)
+				elif id(fragment) in self.replaced:
+					out.append(self.replaced[id(fragment)])
+				else:
+					stack.append((node, pos, dropped))
+					stack.append((fragment, 0, self.dropped(fragment)))
+					break
+
+		return "".join(out)
+
+	def run_predicate(self, testcase):
+		self.runs += 1
+
+		(tfd, candidate) = tempfile.mkstemp(prefix="dharma_reduce_", suffix=self.extension)
+
+		try:
+			ofd = os.fdopen(tfd, 'wb')
+			ofd.write(testcase)
+			ofd.close()
+
+			if self.predicate.find("{}") != -1:
+				command = self.predicate.replace("{}", candidate)
+			else:
+				command = self.predicate + " " + candidate
+
+			devnull = open(os.devnull, 'w')
+			status = subprocess.call(command, shell=True, stdout=devnull, stderr=devnull)
+			devnull.close()
+		except (IOError, OSError), err:
+			raise dharma_error("error running predicate: " + str(err))
+		finally:
+			os.unlink(candidate)
+
+		return status == 0
+
+	# only strictly smaller candidates are tried and every content is run at most once
+	def test(self):
+		content = self.render()
+
+		if len(content) >= len(self.best):
+			return False
+
+		key = hashlib.sha1(content).digest()
+
+		if not key in self.results:
+			self.results[key] = self.run_predicate(self.prefix + content + self.suffix)
+
+		if self.results[key]:
+			self.best = content
+
+		return self.results[key]
+
+	def keep_iterations(self, node, r, keep, candidate):
+		self.kept[(id(node), r)] = candidate
+
+		if self.test():
+			return True
+
+		self.kept[(id(node), r)] = keep
+
+		return False
+
+	# drop all but the first iteration, then chunks of halving size
+	def reduce_repeat(self, node, r):
+		keep = range(0, len(node.repeats[r]))
+
+		if len(keep) < 2 or self.keep_iterations(node, r, keep, keep[:1]):
+			return
+
+		size = len(keep) / 2
+
+		while size >= 1:
+			i = 0
+
+			while i < len(keep) and len(keep) > 1:
+				candidate = keep[:i] + keep[i+size:]
+
+				if len(candidate) != 0 and self.keep_iterations(node, r, keep, candidate):
+					keep = candidate
+				else:
+					i += size
+
+			size /= 2
+
+		return
+
+	# walk the tree breadth first, so the largest subtrees are tried before their children
+	def reduce(self):
+		if not self.run_predicate(self.prefix + self.best + self.suffix):
+			raise dharma_error("the recorded testcase does not satisfy the predicate")
+
+		queue = collections.deque([self.tree])
+
+		while len(queue) != 0:
+			node = queue.popleft()
+
+			if node is not self.tree and node.rule in self.minimal:
+				self.replaced[id(node)] = self.minimal[node.rule]
+
+				if self.test():
+					continue
+
+				del self.replaced[id(node)]
+
+			for r in range(0, len(node.repeats)):
+				self.reduce_repeat(node, r)
+
+			dropped = self.dropped(node)
+			pos = 0
+
+			while pos < len(node):
+				if pos in dropped:
+					pos = dropped[pos]
+					continue
+
+				if isinstance(node[pos], list):
+					queue.append(node[pos])
+
+				pos += 1
+
+		return self.prefix + self.best + self.suffix
+
+# derive new testcases from a corpus of saved derivation trees. every variant changes one
+# subtree of a corpus testcase, it is either regenerated from its rule or replaced by a subtree
+# of the same rule from another corpus testcase. only the path above the subtree is copied
+class dharma_mutator:
+
+	def __init__(self, machine, corpus):
+		self.machine = machine
+		self.rules = machine.rule_objects()
+		self.trees = []
+		self.donors = {}
+
+		for tree_file in corpus_files(corpus):
+			(tree, prefix, suffix, counts) = load_tree(tree_file)
+			entries = tree_entries(tree)
+
+			for (node, parent, pos) in entries[1:]:
+				self.donors.setdefault(node.rule, []).append(node)
+
+			self.trees.append((entries, None, counts))
+
+		if len(self.trees) == 0:
+			raise dharma_error("no derivation trees found in mutation corpus")
+
+		# subtrees that can be neither regenerated nor swapped for another one are left alone
+		for t in range(0, len(self.trees)):
+			(entries, candidates, counts) = self.trees[t]
+			candidates = [i for i in range(1, len(entries)) if entries[i][0].rule in self.rules or len(self.donors[entries[i][0].rule]) > 1]
+			self.trees[t] = (entries, candidates, counts)
+
+		return
+
+	# start from the variable state the corpus testcase ended with, so regenerated subtrees
+	# refer to elements that exist in it
+	def restore(self, ctx, counts):
+		ctx.reset()
+
+		for var in self.machine.variable_keys:
+			ctx.counts[self.machine.variable[var]] = counts.get(var, 0)
+
+		return
+
+	def mutate(self, ctx):
+		(entries, candidates, counts) = self.trees[ctx.rng.randint(0, len(self.trees)-1)]
+
+		self.restore(ctx, counts)
+
+		if len(candidates) == 0:
+			return entries[0][0]
+
+		target = candidates[ctx.rng.randint(0, len(candidates)-1)]
+		node = entries[target][0]
+		donors = self.donors[node.rule]
+
+		if node.rule in self.rules and (len(donors) < 2 or ctx.rng.random() >= ctx.const.MUTATE_SPLICE_RATIO):
+			replacement = self.rules[node.rule].derive(ctx)
+		else:
+			donor = ctx.rng.randint(0, len(donors)-1)
+
+			if donors[donor] is node:
+				donor = (donor + 1) % len(donors)
+
+			replacement = donors[donor]
+
+		return self.add_defaults(ctx, self.replace(entries, target, replacement))
+
+	# copy the nodes from the target up to the root and link the replacement in
+	def replace(self, entries, target, replacement):
+		(node, parent, pos) = entries[target]
+
+		while parent != None:
+			copy = copy_node(entries[parent][0])
+			copy[pos] = replacement
+			replacement = copy
+
+			(node, parent, pos) = entries[parent]
+
+		return replacement
+
+	# a regenerated subtree can refer to a variable the corpus testcase never defined, its
+	# default is added in front of the testcase like generate_content does
+	def add_defaults(self, ctx, tree):
+		tabs = "\t" * self.machine.tabs
+		variables = []
+
+		for var in self.machine.variable_keys:
+			variable = self.machine.variable[var]
+
+			if variable in ctx.defaults and len(ctx.defaults[variable]) != 0:
+				variables.append(tabs + ctx.const.VARIANCE_PREFIX)
+				variables.append(ctx.default_trees[variable])
+				variables.append(ctx.const.VARIANCE_SUFFIX + "\n")
+
+		if len(variables) == 0:
+			return tree
+
+		root = dharma_node(tree.rule)
+		root.alt = tree.alt
+		root.extend(variables + tree)
+		root.repeats = [[(start + len(variables), end + len(variables)) for (start, end) in spans] for spans in tree.repeats]
+
+		return root
+
+class dharma_machine:
+
+	# classify a grammar line in a single match: lines that are complete comments, constants,
+	# includes, section switches, empty lines or assignment heads, otherwise any line starting with a tab
+	LINE_REGEX = re.compile(
+		"(?:(?P<comment>%%%.*)"
+		"|(?P<const>%const% *(?P<const_name>[A-Z_]+) *:= *(?P<const_val>.*))"
+		"|(?P<include>%include% *:= *(?P<include_file>.*?) *)"
+		"|(?P<pool>%pool% *:= *(?P<pool_ident>[a-zA-Z0-9_]+) *)"
+		"|(?P<section>%[sS][eE][cC][tT][iI][oO][nN]% *:= *(?P<section_mode>"
+			"[vV][aA][lL][uU][eE]|[vV][aA][rR][iI][aA][bB][lL][eE]|[vV][aA][rR][iI][aA][nN][cC][eE]))"
+		"|(?P<empty> *|\t*)"
+		"|(?P<top>(?P<ident>[a-zA-Z0-9_]+) *:= *))\n\Z"
+		"|(?P<assign>\t)")
+
+	VARIABLE_ASSIGN_REGEX = re.compile("\@(?P<variable>[a-zA-Z0-9_]+)\@")
+
+	def __init__(self, out="", filetype=dharma_const.DEFAULT_FILETYPE, prefix="", suffix="", count=dharma_const.DEFAULT_COUNT, tabs=dharma_const.DEFAULT_TABS):
+		self.section = dharma_const.VOID_SECTION
+		self.level = dharma_const.TOP_LEVEL
+		self.line_number = 0
+		self.current_obj = 0
+		self.value = {}
+		self.variable = {}
+		self.variance = {}
+		self.variable_keys = []
+		self.variance_keys = []
+		self.consts = []
+		self.includes = []
+		self.pools = []
+		self.pooled = []
+		self.units = []
+
+		self.out = out.rstrip("/")
+		self.filetype = filetype
+		self.prefix = prefix
+		self.suffix = suffix
+		self.count = count
+		self.tabs = tabs
+
+		# the dharma_context generate_one, testcases and generate_range use by default
+		self.context = None
+
+		self.stream = None
+		self.stream_lock = None
+		self.delimiter = None
+		self.dedup = None
+		self.mutator = None
+		self.fanout = 0
+	
+	def parse_line(self, line):
+		self.line_number += 1
+
+		m = dharma_machine.LINE_REGEX.match(line)
+
+		if m == None:
+			kind = None
+		else:
+			kind = m.lastgroup
+
+		if kind == "comment":
+			return
+
+		if kind == "const":
+			self.parse_const(m.group("const_name"), m.group("const_val"))
+			return
+
+		if kind == "include":
+			self.includes.append(m.group("include_file"))
+			return
+
+		if kind == "pool":
+			self.pools.append(m.group("pool_ident"))
 			return
 
-		for xref in self.reverse_xref[obj.ident]:
-			xrefobj = self.value[xref]
+		if kind == "section":
+			self.set_section(m.group("section_mode"))
+			return
+
+		if kind == "empty":
+			if obj_type(self.current_obj) == "dharma_object":
+				raise dharma_error("empty assignment (line %d)" % self.line_number)
+			elif self.current_obj != 0:
+				self.add_section_object()
+
+			self.level = dharma_const.TOP_LEVEL
+			self.current_obj = 0
+			return
+
+		if self.section == dharma_const.VOID_SECTION:
+			raise dharma_error("non-empty line in void section (line %d)" % self.line_number)
+
+		if self.level == dharma_const.TOP_LEVEL:
+			if kind != "top":
+				raise dharma_error("top level syntax error (line %d)" % self.line_number)
+
+			self.parse_top_level(m.group("ident"))
+		elif self.level == dharma_const.ASSIGN_LEVEL:
+			if kind != "assign":
+				raise dharma_error("assign level syntax error (line %d)" % self.line_number)
+
+			self.parse_assign_level(line)
+
+		return
+
+	def parse_top_level(self, ident_str):
+		self.current_obj = dharma_object(ident_str)
+
+		self.level = dharma_const.ASSIGN_LEVEL
+
+		return
+
+	def parse_assign_level(self, line):
+		assign_str = line[1:]
+
+		if self.section == dharma_const.VALUE_SECTION:
+			self.parse_assign_value(assign_str)
+		elif self.section == dharma_const.VARIABLE_SECTION:
+			self.parse_assign_variable(assign_str)
+		elif self.section == dharma_const.VARIANCE_SECTION:
+			self.parse_assign_variance(assign_str)
+		else:
+			raise dharma_error("invalid state for assignment (line %d)" % self.line_number)
+
+		self.parse_xref(line)
+
+		return
+
+	def parse_assign_value(self, value):
+		value = value.rstrip("\n")
+
+		tstr = "\t" * self.tabs
+
+		value = value.replace("\\n", "\n" + tstr)
+
+		if obj_type(self.current_obj) == "dharma_object":
+			value_obj = dharma_value(self.current_obj.ident)
+			value_obj.add_value(value)
+			self.current_obj = value_obj
+		elif obj_type(self.current_obj) == "dharma_value":
+			self.current_obj.add_value(value)
+		else:
+			raise dharma_error("normal value found in non-normal assignment (line %d)" % self.line_number)
+
+		return
+
+	# record the +value+, !variable! and @element@ references of a line in one scan
+	def parse_xref(self, token):
+		for m in dharma_object.XREF_REGEX.finditer(token):
+			if m.group("value") != None:
+				self.current_obj.add_value_xref(m.group("value"))
+			elif m.group("variable") != None:
+				self.current_obj.add_variable_xref(m.group("variable"))
+			else:
+				self.current_obj.add_element_xref(m.group("element"))
+
+		return
+
+	def parse_assign_variable(self, variable_line):
+		tstr = "\t" * self.tabs
+
+		variable_line = variable_line.replace("\\n", "\n" + tstr)
+
+		m = dharma_machine.VARIABLE_ASSIGN_REGEX.search(variable_line)
+
+		if m == None:
+			raise dharma_error("variable assignment syntax error (line %d)" % self.line_number)
+
+		variable = m.group("variable")
+
+		if variable != self.current_obj.ident:
+			raise dharma_error("variable name mismatch (line %d)" % self.line_number)
+
+		prefix_end = m.start("variable") - 1
+		suffix_start = m.end("variable") + 1
+
+		prefix = variable_line[:prefix_end]
+		suffix = variable_line[suffix_start:].rstrip("\n")
+
+		if obj_type(self.current_obj) == "dharma_object":
+			variable_obj = dharma_variable(self.current_obj.ident)
+			variable_obj.add_default_variable(prefix, suffix)
+			self.current_obj = variable_obj
+		elif obj_type(self.current_obj) == "dharma_variable":
+			self.current_obj.add_default_variable(prefix, suffix)
+		else:
+			raise dharma_error("inconsistent object for variable assignment (line %d)" % self.line_number)
+
+		return
+
+	def parse_assign_variance(self, variance_line):
+		variance_line = variance_line.rstrip("\n")
+
+		tstr = "\t" * self.tabs
+
+		variance_line = variance_line.replace("\\n", "\n" + tstr)
+
+		if obj_type(self.current_obj) == "dharma_object":
+			variance_obj = dharma_variance(self.current_obj.ident)
+			variance_obj.add_variance(variance_line)
+			self.current_obj = variance_obj
+		elif obj_type(self.current_obj) == "dharma_variance":
+			self.current_obj.add_variance(variance_line)
+		else:
+			raise dharma_error("inconsistent object for variance assignment (line %d)" % self.line_number)
+
+		return
+
+	def add_section_object(self):
+		if self.section == dharma_const.VALUE_SECTION:
+			if self.current_obj.ident in self.value:
+				raise dharma_error("redefining value (line %d)" % self.line_number)
+
+			self.value[self.current_obj.ident] = self.current_obj
+		elif self.section == dharma_const.VARIABLE_SECTION:
+			if self.current_obj.ident in self.variable:
+				raise dharma_error("redefining variable (line %d)" % self.line_number)
+
+			self.variable[self.current_obj.ident] = self.current_obj
+		elif self.section == dharma_const.VARIANCE_SECTION:
+			if self.current_obj.ident in self.variance:
+				raise dharma_error("redefining variance (line %d)" % self.line_number)
+			
+			self.variance[self.current_obj.ident] = self.current_obj
+		else:
+			raise dharma_error("inconsistent section value, fatal")
+		return
+
+	def parse_const(self, const, val):
+		if not const in dharma_const.__dict__:
+			raise dharma_error("trying to set non-existent constant (line %d)" % self.line_number)
+
+		if len(val) == 0:
+			raise dharma_error("empty constant value (line %d)" % self.line_number)
+
+		try:
+			if val[0] == "\"":
+				if len(val) < 2 or val[-1] != "\"":
+					raise ValueError
+				val = val[1:len(val)-1]
+			elif val.find(".") != -1:
+				val = float(val)
+			else:
+				val = int(val)
+		except ValueError:
+			raise dharma_error("invalid value for constant " + const + " (line %d)" % self.line_number)
+
+		self.consts.append((const, val))
+
+	def match_value_range(self, value_line):
+		return re.match("^(-|)[0-9]+(\.[0-9]+|)-[0-9]+(\.[0-9]+|)\n$", value_line)
+
+	def match_value_repeater(self, value_line):
+		return re.search("\.\.\.", value_line)
+
+	def set_section(self, section_mode):
+		new_section_str = section_mode.upper() + "_SECTION"
+		new_section = getattr(dharma_const, new_section_str)
+		self.section = new_section
+		return
+
+	def resolve_xref(self):
+		self.resolve_section_xref(self.value)
+		self.resolve_section_xref(self.variable)
+		self.resolve_section_xref(self.variance)
+
+		# fix the iteration order used during generation so cached grammars generate identically
+		self.variable_keys = self.variable.keys()
+		self.variance_keys = self.variance.keys()
+
+		return
+
+	def resolve_section_xref(self, section):
+		for v in section:
+			obj = section[v]
+			self.resolve_object_xref(obj)
+
+		return
+
+	def resolve_object_xref(self, obj):
+		for x in obj.value_xref:
+			if not x in self.value:
+				raise dharma_error("undefined value reference from " + obj.ident + " to " + x)
+
+			obj.value_xref[x] = self.value[x]
+
+		for x in obj.variable_xref:
+			if not x in self.variable:
+				raise dharma_error("undefined variable reference from " + obj.ident + " to " + x)
+
+			obj.variable_xref[x] = self.variable[x]
+
+		for x in obj.element_xref:
+			if not x in self.variable:
+				raise dharma_error("element reference without a default variable from " + obj.ident + " to " + x)
+
+			obj.element_xref[x] = self.variable[x]
+
+		return
+
+	# the shortest output of every terminating rule, built from the cheapest alternative in the
+	# cost table. objects are visited by depth so every referenced value is already built
+	def minimal_expansions(self):
+		objs = [obj for obj in self.value.values() + self.variable.values() + self.variance.values() if obj.depth != None]
+		objs.sort(key=lambda obj: obj.depth)
+
+		minimal = {}
+
+		for obj in objs:
+			best = min([i for i in range(len(obj.cost)) if obj.cost[i] != None], key=lambda i: obj.cost[i])
+			minimal[obj] = self.minimal_segments(obj, obj.alternatives()[best], minimal)
+
+		return dict((rule_name(obj), text) for (obj, text) in minimal.items())
+
+	def minimal_segments(self, obj, segments, minimal):
+		out = []
+
+		for seg in segments:
+			seg_type = seg[0]
+
+			if seg_type == dharma_const.LITERAL_SEGMENT:
+				out.append(seg[1])
+			elif seg_type == dharma_const.VALUE_SEGMENT:
+				out.append(minimal[obj.value_xref[seg[1]]])
+			elif seg_type == dharma_const.VARIABLE_SEGMENT or seg_type == dharma_const.ELEMENT_SEGMENT:
+				out.append(seg[1] + "1")
+			elif seg_type == dharma_const.RANGE_SEGMENT:
+				(range_type, start_idx, end_idx) = seg[1]
+
+				if range_type == dharma_const.CHAR_RANGE:
+					out.append(chr(start_idx))
+				else:
+					out.append(str(start_idx))
+			else:
+				out.append(self.minimal_segments(obj, seg[1][0], minimal))
+
+		return "".join(out)
+
+	# single pass over the grammar computing, for every rule and alternative, the minimum expansion
+	# depth and output size needed to terminate. alternatives are finalised cheapest first (knuth's
+	# generalisation of dijkstra), which is exact because an alternative always costs more than the
+	# rules it expands.
+	def calculate_leaf_costs(self):
+		objs = self.value.values() + self.variable.values() + self.variance.values()
+
+		waiting = {}
+		heap = []
+		repeats = {}
+		seq = 0
+
+		for obj in objs:
+			alternatives = obj.alternatives()
+
+			obj.cost = [None] * len(alternatives)
+			obj.depth = None
+			obj.size = None
+
+			repeats[obj] = []
+
+			for i in range(len(alternatives)):
+				(size, refs, repeat) = obj.segment_cost(alternatives[i])
+				repeats[obj].append(repeat)
+
+				deps = set(refs)
+				alternative = [obj, i, size, refs, len(deps)]
+
+				for dep in deps:
+					if not dep in waiting:
+						waiting[dep] = []
+
+					waiting[dep].append(alternative)
+
+				if len(deps) == 0:
+					obj.cost[i] = (1, size)
+					heapq.heappush(heap, (1, size, seq, obj))
+					seq += 1
+
+		while len(heap) != 0:
+			(depth, size, s, obj) = heapq.heappop(heap)
+
+			if obj.depth != None:
+				continue
+
+			obj.depth = depth
+			obj.size = size
+
+			if not obj in waiting:
+				continue
+
+			for alternative in waiting[obj]:
+				alternative[4] -= 1
+
+				if alternative[4] != 0:
+					continue
+
+				(altobj, i, size, refs) = alternative[:4]
+
+				depth = 1
+				for ref in refs:
+					depth = max(depth, ref.depth + 1)
+					size += ref.size
+
+				altobj.cost[i] = (depth, size)
+				heapq.heappush(heap, (depth, size, seq, altobj))
+				seq += 1
+
+		for obj in objs:
+			obj.leaf = []
+
+			for i in range(len(obj.cost)):
+				if obj.cost[i] != None and obj.cost[i][0] == obj.depth:
+					obj.leaf.append(i)
+
+			# favour non-repeating
+			leaf = [i for i in obj.leaf if not repeats[obj][i]]
+
+			if len(leaf) != 0:
+				obj.leaf = leaf
+
+		return
+
+	# every rule a variance can reach, through values, variables and elements
+	def reachable(self):
+		seen = set(self.variance.values())
+		stack = list(seen)
+
+		while len(stack) != 0:
+			obj = stack.pop()
+
+			for ref in obj.value_xref.values() + obj.variable_xref.values() + obj.element_xref.values():
+				if not ref in seen:
+					seen.add(ref)
+					stack.append(ref)
+
+		return seen
+
+	# leaf mode can only bring a testcase to an end when every rule it may meet terminates
+	def check_termination(self):
+		names = [rule_name(obj) for obj in self.reachable() if obj.depth == None]
+
+		if len(names) != 0:
+			raise dharma_error("no terminating alternative in " + ", ".join(sorted(names)))
+
+		return
+
+	def parse(self, data):
+		for line in cStringIO.StringIO(data):
+			self.parse_line(line)
+
+		# a grammar that does not end in an empty line still completes its last assignment
+		if self.current_obj != 0:
+			self.parse_line("\n")
+
+		return
+
+	def resolve(self):
+		self.resolve_xref()
+		self.calculate_leaf_costs()
+		self.check_termination()
+		self.build_alias_tables()
+
+		for ident in self.pools:
+			self.add_pool(ident)
+
+		return
+
+	# pool the expansions of a value. only values whose expansions never refer to variables or
+	# elements can be reused, anywhere else their output would depend on the testcase state
+	def add_pool(self, ident):
+		if not ident in self.value:
+			raise dharma_error("no value " + ident + " to pool")
+
+		obj = self.value[ident]
+		seen = set([obj])
+		stack = [obj]
+
+		while len(stack) != 0:
+			value = stack.pop()
+
+			if len(value.variable_xref) != 0 or len(value.element_xref) != 0:
+				raise dharma_error("pooled value " + ident + " refers to variables or elements through " + value.ident)
+
+			for ref in value.value_xref.values():
+				if not ref in seen:
+					seen.add(ref)
+					stack.append(ref)
+
+		if not obj.pooled:
+			obj.pooled = True
+			self.pooled.append(obj)
+
+		return
+
+	def build_alias_tables(self):
+		for obj in self.value.values() + self.variance.values():
+			obj.build_alias()
+
+		return
+
+	# change the weight of one alternative of a value or variance, given by its rule name as
+	# in profile reports ("value:<ident>"), without reparsing the grammar
+	def set_weight(self, rule, alt, weight):
+		rules = self.rule_objects()
+
+		if not rule in rules:
+			raise dharma_error("no value or variance " + rule)
+
+		rules[rule].set_weight(alt, weight)
+
+		return
+
+	# parse, link and resolve the grammar, going through the compiled cache when a cache file is
+	# given. grammar_file locates %include% files. returns True when the cache was used
+	def compile(self, data, cache_file=None, grammar_file="", cache_dir=None):
+		if cache_file != None:
+			key = self.cache_key(data)
+
+			if self.load_cache(cache_file, key):
+				return True
+
+		self.parse(data)
+		self.link(grammar_file, cache_file != None, cache_dir)
+		self.resolve()
+
+		if cache_file != None:
+			self.save_cache(cache_file, key)
+
+		return False
+
+	# merge the rules of every %include% file into this grammar, included files first. each
+	# included file is parsed on its own and kept in a unit cache, so editing one file only
+	# reparses that file. %const% settings apply in include order, the including file last
+	def link(self, grammar_file="", cache=False, cache_dir=None):
+		own_consts = self.consts
+
+		self.consts = []
+		self.units = []
+
+		if grammar_file != "":
+			stack = [os.path.normpath(grammar_file)]
+		else:
+			stack = []
+
+		self.link_includes(self.includes, os.path.dirname(grammar_file), cache, cache_dir, stack, set())
+
+		self.consts += own_consts
+
+		return len(self.units)
+
+	def link_includes(self, includes, base_dir, cache, cache_dir, stack, linked):
+		for include in includes:
+			path = os.path.normpath(os.path.join(base_dir, include))
+
+			if path in stack:
+				raise dharma_error("include cycle through " + path)
+
+			if path in linked:
+				continue
+
+			unit = self.load_unit(path, cache, cache_dir)
+
+			self.link_includes(unit.includes, os.path.dirname(path), cache, cache_dir, stack + [path], linked)
+			linked.add(path)
+
+			for (section, unit_section, name) in ((self.value, unit.value, "value"), (self.variable, unit.variable, "variable"), (self.variance, unit.variance, "variance")):
+				for ident in unit_section:
+					if ident in section:
+						raise dharma_error("redefining " + name + " " + ident + " included from " + path)
+
+					section[ident] = unit_section[ident]
+
+			self.consts += unit.consts
+			self.pools += unit.pools
+
+		return
+
+	def load_unit(self, path, cache, cache_dir):
+		try:
+			fd = open(path, 'r')
+			data = fd.read()
+			fd.close()
+		except IOError, err:
+			raise dharma_error("error opening included file: " + str(err))
+
+		unit = dharma_machine(tabs=self.tabs)
+		key = unit.cache_key(data)
+		unit_file = cache_path(path, cache_dir, dharma_const.UNIT_CACHE_EXTENSION)
+
+		if not cache or not unit.load_cache(unit_file, key, False):
+			try:
+				unit.parse(data)
+			except dharma_error, err:
+				raise dharma_error(path + ": " + str(err))
+
+			if cache:
+				unit.save_cache(unit_file, key)
+
+		self.units.append((path, key))
+
+		return unit
+
+	def cache_key(self, data):
+		return hashlib.sha1(dharma_const.DHARMA_VERSION + "\0" + str(self.tabs) + "\0" + data).hexdigest()
+
+	# a resolved cache is only valid while every included file is unchanged, unit caches of
+	# included files hold parsed rules that have not been linked or resolved yet
+	def load_cache(self, cache_file, key, resolved=True):
+		try:
+			fd = open(cache_file, 'rb')
+			cache = cPickle.load(fd)
+			fd.close()
+		except:
+			return False
+
+		if type(cache) != dict or cache.get("key") != key:
+			return False
+
+		for (path, unit_key) in cache["units"]:
+			try:
+				fd = open(path, 'r')
+				data = fd.read()
+				fd.close()
+			except IOError:
+				return False
+
+			if self.cache_key(data) != unit_key:
+				return False
+
+		self.value = cache["value"]
+		self.variable = cache["variable"]
+		self.variance = cache["variance"]
+		self.consts = cache["consts"]
+		self.includes = cache["includes"]
+		self.pools = cache["pools"]
+		self.units = cache["units"]
+
+		if not resolved:
+			return True
+
+		self.resolve_xref()
+		self.pooled = [obj for obj in self.value.values() if obj.pooled]
+
+		# keep the generation order recorded when the cache was built
+		self.variable_keys = cache["variable_keys"]
+		self.variance_keys = cache["variance_keys"]
+
+		return True
+
+	def save_cache(self, cache_file, key):
+		cache = {
+			"key": key,
+			"value": self.value,
+			"variable": self.variable,
+			"variance": self.variance,
+			"variable_keys": self.variable_keys,
+			"variance_keys": self.variance_keys,
+			"consts": self.consts,
+			"includes": self.includes,
+			"pools": self.pools,
+			"units": self.units,
+		}
+
+		try:
+			(tfd, tmp_file) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_file)))
+			ofd = os.fdopen(tfd, 'wb')
+			cPickle.dump(cache, ofd, cPickle.HIGHEST_PROTOCOL)
+			ofd.close()
+			os.rename(tmp_file, cache_file)
+		except (IOError, OSError):
+			return False
+
+		return True
+
+	# a generator over this grammar. the grammar is only read while generating, so threads can
+	# each generate from their own context. budgets are (const, value) pairs that take
+	# precedence over the %const% settings of the grammar
+	def new_context(self, seed=0, budget=[]):
+		return dharma_context(self.consts + budget, seed)
+
+	def get_context(self, context=None):
+		if context != None:
+			return context
+
+		if self.context == None:
+			self.context = self.new_context()
+
+		return self.context
+
+	def generate_one(self, index=1, seed=None, context=None):
+		ctx = self.get_context(context)
+
+		if seed != None:
+			ctx.seed = seed
+
+		ctx.seed_testcase(index)
+
+		return self.prefix + self.generate_content(ctx) + self.suffix
+
+	def testcases(self, count=None, seed=None, context=None):
+		ctx = self.get_context(context)
+
+		if seed != None:
+			ctx.seed = seed
+
+		if count == None:
+			numbers = itertools.count(1)
+		else:
+			numbers = xrange(1, count+1)
+
+		for n in numbers:
+			yield self.generate_one(n, context=ctx)
+
+	def __iter__(self):
+		return self.testcases()
+
+	def generate(self):
+		if self.count == 0:
+			self.generate_range(1, None)
+		else:
+			self.generate_range(1, self.count)
+		return
+
+	# fork one worker per job after the grammar has been resolved, each with its own slice
+	# of testcase numbers. testcases are seeded by number, so the output does not depend on jobs
+	def generate_jobs(self, jobs):
+		if not hasattr(os, "fork"):
+			raise dharma_error("parallel generation requires os.fork")
+
+		sys.stdout.flush()
+
+		pids = []
+		reports = []
+
+		# profiles and coverage state are collected per worker and merged back here
+		ctx = self.get_context()
+		collectors = [c for c in (ctx.profile, ctx.coverage) if c != None]
+
+		for job in range(0, jobs):
+			step = 1
+
+			# unbounded workers interleave their testcase numbers so no two generate the same one
+			if self.count == 0:
+				(first, last, step) = (1 + job, None, jobs)
+			else:
+				first = 1 + (self.count * job) / jobs
+				last = (self.count * (job + 1)) / jobs
+
+				if first > last:
+					continue
+
+			report_files = []
+
+			for collector in collectors:
+				(tfd, report_file) = tempfile.mkstemp(prefix="dharma_report_")
+				os.close(tfd)
+				report_files.append(report_file)
+				reports.append((collector, report_file))
+
+			pid = os.fork()
+
+			if pid == 0:
+				status = 0
+
+				for collector in collectors:
+					collector.mark()
+
+				try:
+					self.generate_range(first, last, step)
+				except dharma_stream_closed:
+					pass
+				except dharma_error, err:
+					sys.stderr.write("e: " + str(err) + "\n")
+					status = 1
+				except:
+					traceback.print_exc()
+					status = 1
+
+				for (collector, report_file) in zip(collectors, report_files):
+					collector.save_report(report_file)
+
+				sys.stdout.flush()
+				os._exit(status & 0xff)
+
+			pids.append(pid)
+
+		failed = 0
+
+		for pid in pids:
+			(pid, status) = os.waitpid(pid, 0)
+
+			if status != 0:
+				failed += 1
+
+		for (collector, report_file) in reports:
+			collector.merge_report(report_file)
+			os.unlink(report_file)
+
+		if failed != 0:
+			raise dharma_error("%d generation worker(s) failed" % failed)
+
+		return
+
+	# write testcases as records on a stream instead of one file each. records are either
+	# terminated by the delimiter or prefixed with their length as a 32-bit network order integer
+	def open_stream(self, target, delimiter):
+		try:
+			if target == dharma_const.STREAM_STDOUT:
+				self.stream = sys.__stdout__
+			elif target.startswith(dharma_const.STREAM_UNIX_PREFIX):
+				sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+				sock.connect(target[len(dharma_const.STREAM_UNIX_PREFIX):])
+				self.stream = sock.makefile('wb')
+			else:
+				self.stream = open(target, 'wb')
+		except (IOError, OSError, socket.error), err:
+			raise dharma_error("error opening output stream " + target + ": " + str(err))
+
+		self.delimiter = delimiter
+		self.stream_lock = multiprocessing.Lock()
+
+		return
+
+	def write_record(self, data):
+		record = pack_record(data, self.delimiter)
+
+		self.stream_lock.acquire()
+
+		try:
+			self.stream.write(record)
+			self.stream.flush()
+		except (IOError, socket.error), err:
+			# the consumer hanging up is the normal end of an unbounded stream
+			if err.errno == errno.EPIPE:
+				raise dharma_stream_closed("output stream closed by consumer")
+
+			raise dharma_error("error writing output stream: " + str(err))
+		finally:
+			self.stream_lock.release()
+
+		return
+
+	def generate_content(self, ctx):
+		ctx.reset()
+
+		nvar = ctx.rng.randint(ctx.const.VARIANCE_MIN, ctx.const.VARIANCE_MAX)
+
+		if len(self.variance) == 0:
+			raise dharma_error("no variances found in grammar")
+
+		tabs = "\t" * self.tabs
+		variances = []
+
+		for i in range(0, nvar):
+			svar = ctx.rng.randint(0, len(self.variance)-1)
+			skey = self.variance_keys[svar]
+
+			ctx.leaf_mode = ctx.converge
+			ctx.leaf_trigger = 0
+
+			variances.append(tabs + ctx.const.VARIANCE_PREFIX)
+			variances.append(self.variance[skey].derive(ctx))
+			variances.append(ctx.const.VARIANCE_SUFFIX + "\n")
 
-			xrefobj.add_leaf_path(leaf, obj.ident, depth)
+		variables = []
 
-			if xrefobj in node_seen:
-				continue
+		for var in self.variable_keys:
+			variable = self.variable[var]
+
+			if variable in ctx.defaults and len(ctx.defaults[variable]) != 0:
+				variables.append(tabs + ctx.const.VARIANCE_PREFIX)
+
+				if ctx.record:
+					variables.append(ctx.default_trees[variable])
+				else:
+					variables.append(ctx.defaults[variable])
+
+				variables.append(ctx.const.VARIANCE_SUFFIX + "\n")
+
+		# the variance lines of a testcase are reduced like the iterations of a %repeat%
+		if ctx.record:
+			ctx.tree = dharma_node()
+			ctx.tree.extend(variables + variances)
+			ctx.tree.repeats.append([(len(variables) + i, len(variables) + i + 3) for i in range(0, len(variances), 3)])
+
+		return join_fragments(variables + variances)
+
+	def variable_counts(self, ctx):
+		return dict((var, ctx.counts.get(self.variable[var], 0)) for var in self.variable_keys)
+
+	# values and variances by rule name, the rules a saved derivation can be regenerated from
+	def rule_objects(self):
+		return dict((rule_name(obj), obj) for obj in self.value.values() + self.variance.values())
+
+	def mutate_content(self, ctx):
+		ctx.tree = self.mutator.mutate(ctx)
+
+		return join_fragments(ctx.tree)
+
+	# with duplicate suppression a duplicate is regenerated from a seed derived from the attempt
+	# number, and the testcase is skipped (None) when every retry is a duplicate as well
+	def generate_testcase(self, ctx, n):
+		attempt = 0
+
+		while True:
+			ctx.seed_testcase(n, attempt)
+
+			if self.mutator != None:
+				content = self.mutate_content(ctx)
+			else:
+				content = self.generate_content(ctx)
+
+			if self.dedup == None or self.dedup.add(content):
+				return content
+
+			if attempt == ctx.const.DEDUP_RETRIES:
+				self.dedup.skip()
 
-			node_seen.append(xrefobj)
-			self.propogate_leaf(leaf, xrefobj, node_seen, depth+1)
+				return None
+
+			attempt += 1
+
+	# a last testcase number of None generates until the stream is closed
+	def generate_range(self, first, last, step=1):
+		if last == None:
+			numbers = itertools.count(first, step)
+		else:
+			numbers = xrange(first, last+1, step)
+
+		ctx = self.get_context()
+
+		if self.stream != None:
+			writer = None
+		else:
+			writer = dharma_writer(ctx.const)
+
+		try:
+			for n in numbers:
+				content = self.generate_testcase(ctx, n)
+
+				if content == None:
+					continue
+
+				if writer == None:
+					self.write_record(self.prefix + content + self.suffix)
+					continue
+
+				out_file = self.testcase_path(n)
+
+				writer.write(out_file, self.prefix + content + self.suffix)
+
+				if ctx.record:
+					writer.write(out_file + dharma_const.TREE_EXTENSION, dump_tree(ctx.tree, self.prefix, self.suffix, self.variable_counts(ctx)))
+		finally:
+			if writer != None:
+				writer.close()
 
 		return
 
-	def generate(self):
-		for n in range(1, self.count+1):
-			out_file = self.out + "/" + str(n) + "." + self.filetype
+	# keep pending testcases waiting in the output directory until interrupted. new ones are only
+	# generated after consumers removed old ones, and only once the queued files are on disk
+	# the next number is kept in the manifest ahead of every batch, so a restarted watcher never
+	# hands out a number again even when consumers already removed its testcase
+	def generate_watch(self, pending, grammar_file):
+		ctx = self.get_context()
+		watcher = dharma_watcher(self.out, self.filetype, ctx.const)
+		writer = dharma_writer(ctx.const)
 
-			try:
-				ofd = open(out_file, 'w')
-			except:
-				print "e: error opening output file " + out_file
-				sys.exit(-1)
+		try:
+			n = max(watcher.next_number(), self.manifest_next())
+
+			while True:
+				batch = range(watcher.pending(), pending)
+
+				self.write_manifest(grammar_file, n + len(batch))
+
+				for i in batch:
+					content = self.generate_testcase(ctx, n)
+
+					if content != None:
+						out_file = self.testcase_path(n)
+
+						writer.write(out_file, self.prefix + content + self.suffix)
+
+						if ctx.record:
+							writer.write(out_file + dharma_const.TREE_EXTENSION, dump_tree(ctx.tree, self.prefix, self.suffix, self.variable_counts(ctx)))
+
+					n += 1
+
+				writer.flush()
+
+				while watcher.pending() >= pending:
+					watcher.wait()
+		finally:
+			watcher.close()
+			writer.close()
+
+	# with fan-out, testcases are spread over levels of subdirectories named after the hash of
+	# their number, so the path of any testcase is known without listing the output directory
+	def testcase_path(self, n):
+		name = str(n) + "." + self.filetype
+		digest = hashlib.sha1(str(n)).hexdigest()
+		width = self.get_context().const.FANOUT_WIDTH
+
+		dirs = [digest[level*width:(level+1)*width] for level in range(0, self.fanout)]
+
+		return os.path.join(self.out, *(dirs + [name]))
+
+	def write_manifest(self, grammar_file, next_number=None):
+		manifest_file = self.out + "/" + dharma_const.MANIFEST_FILE
+		tmp_file = self.out + "/." + dharma_const.MANIFEST_FILE + ".tmp"
+
+		try:
+			ofd = open(tmp_file, 'w')
+			ofd.write("version " + dharma_const.DHARMA_VERSION + "\n")
+			ofd.write("grammar " + grammar_file + "\n")
+			ofd.write("seed " + str(self.get_context().seed) + "\n")
+			ofd.write("count " + str(self.count) + "\n")
+			ofd.write("filetype " + self.filetype + "\n")
+			ofd.write("fanout " + str(self.fanout) + "\n")
+
+			if next_number != None:
+				ofd.write("next " + str(next_number) + "\n")
+
+			ofd.close()
+			os.rename(tmp_file, manifest_file)
+		except (IOError, OSError), err:
+			raise dharma_error("error writing manifest " + manifest_file + ": " + str(err))
+
+		return
+
+	# the next testcase number recorded by an earlier watcher, 1 when there is none
+	def manifest_next(self):
+		manifest_file = self.out + "/" + dharma_const.MANIFEST_FILE
+
+		try:
+			ifd = open(manifest_file, 'r')
+			lines = ifd.readlines()
+			ifd.close()
+		except IOError:
+			return 1
+
+		for line in lines:
+			fields = line.split()
+
+			if len(fields) == 2 and fields[0] == "next" and fields[1].isdigit():
+				return int(fields[1])
+
+		return 1
+
+# keeps resolved grammars resident and serves testcases over http on a tcp or unix socket. a
+# grammar is reloaded when its file changes. requests run on their own threads with their own
+# dharma_context, only the check for a changed grammar file and its reload are serialized
+class dharma_server:
+	def __init__(self, prefix="", suffix="", tabs=dharma_const.DEFAULT_TABS, cache=True, cache_dir=None, budget=[]):
+		self.prefix = prefix
+		self.suffix = suffix
+		self.tabs = tabs
+		self.cache = cache
+		self.cache_dir = cache_dir
+		self.budget = budget
+		self.grammars = {}
+		self.grammar_keys = []
+		self.lock = threading.Lock()
+
+	def add_grammar(self, grammar_file):
+		name = os.path.splitext(os.path.basename(grammar_file))[0]
+
+		if name in self.grammars:
+			raise dharma_error("duplicate grammar name " + name)
+
+		self.grammars[name] = self.load(grammar_file)
+		self.grammar_keys.append(name)
+
+		return name
+
+	def load(self, grammar_file):
+		machine = load_grammar(grammar_file, self.prefix, self.suffix, self.tabs, self.cache, self.cache_dir)
 
+		return (grammar_file, self.mtimes(grammar_file, machine), machine)
+
+	# a grammar is stale when the file itself or any file it includes has changed
+	def mtimes(self, grammar_file, machine):
+		mtimes = []
+
+		for path in [grammar_file] + [path for (path, key) in machine.units]:
 			try:
-				ofd.write(self.prefix)
-			except IOError:
-				print "e: error writing prefix section"
-				sys.exit(-1)
+				mtimes.append(os.stat(path).st_mtime)
+			except OSError:
+				mtimes.append(None)
+
+		return mtimes
 
-			for var in self.variable:
-				self.variable[var].clear()
+	# requests run on their own threads, only the reload check is serialized
+	def grammar(self, name):
+		self.lock.acquire()
 
-			nvar = random.randint(dharma_const.VARIANCE_MIN, dharma_const.VARIANCE_MAX)
+		try:
+			(grammar_file, mtimes, machine) = self.grammars[name]
 
-			if len(self.variance) == 0:
-				print "e: no variances found in grammar"
-				sys.exit(-1)
+			if self.mtimes(grammar_file, machine) != mtimes:
+				try:
+					self.grammars[name] = self.load(grammar_file)
+					machine = self.grammars[name][2]
+				except dharma_error, err:
+					sys.stderr.write("w: keeping previous " + name + " grammar, reload failed: " + str(err) + "\n")
 
-			variance_content = ""
+					self.grammars[name] = (grammar_file, self.mtimes(grammar_file, machine), machine)
+		finally:
+			self.lock.release()
 
-			for i in range(0, nvar):
-				svar = random.randint(0, len(self.variance)-1)
-				skey = self.variance.keys()[svar]
+		return machine
 
-				dharma_value.leaf_mode = False
-				dharma_value.leaf_trigger = 0
-				variance = self.variance[skey].generate()
+	def generate(self, name, count, seed, index, delimiter):
+		machine = self.grammar(name)
+		ctx = machine.new_context(seed, self.budget)
 
-				for t in range(0, self.tabs):
-					variance_content += "\t"
+		records = []
 
-				variance_content += dharma_const.VARIANCE_PREFIX
-				variance_content += variance
-				variance_content += dharma_const.VARIANCE_SUFFIX + "\n"
+		for n in xrange(index, index+count):
+			records.append(pack_record(machine.generate_one(n, context=ctx), delimiter))
 
-			variable_content = ""
+		return "".join(records)
 
-			for var in self.variable:
-				if len(self.variable[var].default) != 0:
-					for t in range(0, self.tabs):
-						variable_content += "\t"
+	def serve(self, address):
+		if address.startswith(dharma_const.STREAM_UNIX_PREFIX):
+			path = address[len(dharma_const.STREAM_UNIX_PREFIX):]
 
-					variable_content += dharma_const.VARIANCE_PREFIX
-					variable_content += self.variable[var].default
-					variable_content += dharma_const.VARIANCE_SUFFIX + "\n"
+			if os.path.exists(path):
+				os.unlink(path)
 
 			try:
-				ofd.write(variable_content)
-				ofd.write(variance_content)
-			except:
-				print "e: error writing content section"
-				sys.exit(1)
+				httpd = dharma_unix_http_server(path, dharma_request_handler)
+			except socket.error, err:
+				raise dharma_error("error binding " + path + ": " + str(err))
+		else:
+			if address.find(":") != -1:
+				(host, port) = address.rsplit(":", 1)
+			else:
+				(host, port) = (dharma_const.SERVE_HOST, address)
 
 			try:
-				ofd.write(self.suffix)
-			except:
-				print "e: error writing suffix section"
-				sys.exit(-1)
+				httpd = dharma_http_server((host, int(port)), dharma_request_handler)
+			except (ValueError, socket.error), err:
+				raise dharma_error("error binding " + address + ": " + str(err))
+
+		httpd.dharma = self
+
+		try:
+			httpd.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			httpd.server_close()
+
+			if address.startswith(dharma_const.STREAM_UNIX_PREFIX):
+				os.unlink(path)
 
-			ofd.close()
 		return
 
+class dharma_http_server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+class dharma_unix_http_server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+# GET /<grammar>?count=K&seed=S&index=N&delimiter=D returns testcases N..N+K-1 of seed S framed
+# as stream records. GET / lists the grammars being served
+class dharma_request_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_GET(self):
+		dharma = self.server.dharma
+		url = urlparse.urlparse(self.path)
+		name = url.path.strip("/")
+
+		if name == "":
+			self.send_body("text/plain", "".join(key + "\n" for key in dharma.grammar_keys))
+			return
+
+		if not name in dharma.grammars:
+			self.send_error(404, "unknown grammar " + name)
+			return
+
+		query = urlparse.parse_qs(url.query)
+
+		try:
+			count = int(query.get("count", ["1"])[0])
+			index = int(query.get("index", ["1"])[0])
+
+			if "seed" in query:
+				seed = int(query["seed"][0])
+			else:
+				seed = struct.unpack("!I", os.urandom(4))[0]
+		except ValueError:
+			self.send_error(400, "count, index and seed must be integers")
+			return
+
+		if "delimiter" in query:
+			delimiter = query["delimiter"][0].decode("string_escape")
+		else:
+			delimiter = None
+
+		try:
+			body = dharma.generate(name, count, seed, index, delimiter)
+		except dharma_error, err:
+			self.send_error(500, str(err))
+			return
+
+		self.send_body("application/octet-stream", body, [("X-Dharma-Seed", str(seed))])
+
+	def send_body(self, content_type, body, headers=[]):
+		self.send_response(200)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+
+		for (header, val) in headers:
+			self.send_header(header, val)
+
+		self.end_headers()
+		self.wfile.write(body)
+
+	# unix socket peers have no address
+	def log_message(self, format, *args):
+		if isinstance(self.client_address, tuple):
+			peer = self.client_address[0]
+		else:
+			peer = "local"
+
+		sys.stderr.write("%s - - [%s] %s\n" % (peer, self.log_date_time_string(), format % args))
+
 def obj_type(obj):
 	return obj.__class__.__name__
 
+def rule_name(obj):
+	return obj_type(obj)[len("dharma_"):] + ":" + obj.ident
+
+# mean and variance of a uniform integer in [start, end]
+def uniform_moments(start, end):
+	n = end - start + 1
+
+	return ((start + end) / 2.0, (n * n - 1) / 12.0)
+
+# mean and variance of a %repeat% count, the count is uniform in [1, 2^k] for k uniform in
+# [1, max_power]
+def repeat_moments(max_power):
+	mean = 0.0
+	square = 0.0
+
+	for k in range(1, max_power + 1):
+		(k_mean, k_var) = uniform_moments(1, 2 ** k)
+
+		mean += k_mean / max_power
+		square += (k_var + k_mean ** 2) / max_power
+
+	return (mean, square - mean ** 2)
+
+# mean and variance of the output length of a %range%. integers are split into bands of equal
+# printed length, floats are printed with FLOAT_DIGITS significant digits
+def range_moments(rangeval):
+	(range_type, start_idx, end_idx) = rangeval
+
+	if range_type == dharma_const.CHAR_RANGE:
+		return (1.0, 0.0)
+
+	if range_type == dharma_const.FLOAT_RANGE:
+		return (float(len("%.*g" % (dharma_const.FLOAT_DIGITS, start_idx + (end_idx - start_idx) * 0.618034))), 0.0)
+
+	total = end_idx - start_idx + 1
+
+	if total <= 0:
+		return (float(len(str(start_idx))), 0.0)
+
+	mean = 0.0
+	square = 0.0
+
+	for length in range(1, len(str(max(abs(start_idx), abs(end_idx)))) + 1):
+		if length == 1:
+			low = 0
+		else:
+			low = 10 ** (length - 1)
+
+		high = 10 ** length - 1
+
+		for (band_low, band_high, printed) in ((low, high, length), (-high, -max(1, low), length + 1)):
+			count = min(end_idx, band_high) - max(start_idx, band_low) + 1
+
+			if count > 0:
+				mean += float(count) * printed / total
+				square += float(count) * printed * printed / total
+
+	return (mean, square - mean ** 2)
+
+# Vose's alias method, one uniform index and one coin flip draw from any weight distribution
+def alias_table(weights):
+	count = len(weights)
+	total = sum(weights)
+	scaled = [weight * count / total for weight in weights]
+	prob = [1.0] * count
+	alias = range(count)
+
+	small = [i for i in range(count) if scaled[i] < 1.0]
+	large = [i for i in range(count) if scaled[i] >= 1.0]
+
+	while len(small) != 0 and len(large) != 0:
+		s = small.pop()
+		l = large.pop()
+
+		prob[s] = scaled[s]
+		alias[s] = l
+
+		scaled[l] = scaled[l] + scaled[s] - 1.0
+
+		if scaled[l] < 1.0:
+			small.append(l)
+		else:
+			large.append(l)
+
+	return (prob, alias)
+
+def alias_sample(table, rng):
+	(prob, alias) = table
+
+	i = rng.randint(0, len(prob)-1)
+
+	if rng.random() < prob[i]:
+		return i
+
+	return alias[i]
+
+def pack_record(data, delimiter):
+	if delimiter != None:
+		return data + delimiter
+
+	return struct.pack(dharma_const.STREAM_LENGTH_FORMAT, len(data)) + data
+
+def cache_path(grammar_file, cache_dir=None, extension=dharma_const.CACHE_EXTENSION):
+	if cache_dir != None:
+		return os.path.join(cache_dir, os.path.basename(grammar_file) + extension)
+
+	return grammar_file + extension
+
+# load a grammar file for in-process generation, errors are raised as dharma_error
+def load_grammar(grammar_file, prefix="", suffix="", tabs=dharma_const.DEFAULT_TABS, cache=True, cache_dir=None):
+	try:
+		fd = open(grammar_file, 'r')
+		data = fd.read()
+		fd.close()
+	except IOError, err:
+		raise dharma_error("error opening language file: " + str(err))
+
+	dharma = dharma_machine(prefix=prefix, suffix=suffix, tabs=tabs)
+
+	if cache:
+		dharma.compile(data, cache_path(grammar_file, cache_dir), grammar_file, cache_dir)
+	else:
+		dharma.compile(data, None, grammar_file)
+
+	return dharma
+
+# derivation trees are stored flat with child nodes replaced by their index, so deep trees do
+# not run into the pickle recursion limit
+def dump_tree(tree, prefix, suffix, counts={}):
+	nodes = [tree]
+	flat = []
+
+	for node in nodes:
+		fragments = []
+
+		for fragment in node:
+			if isinstance(fragment, list):
+				fragments.append(len(nodes))
+				nodes.append(fragment)
+			else:
+				fragments.append(fragment)
+
+		flat.append((node.rule, node.alt, node.repeats, fragments))
+
+	return cPickle.dumps({"prefix": prefix, "suffix": suffix, "counts": counts, "nodes": flat}, cPickle.HIGHEST_PROTOCOL)
+
+def save_tree(tree, tree_file, prefix, suffix, counts={}):
+	try:
+		fd = open(tree_file, 'wb')
+		fd.write(dump_tree(tree, prefix, suffix, counts))
+		fd.close()
+	except IOError, err:
+		raise dharma_error("error writing derivation tree " + tree_file + ": " + str(err))
+
+	return
+
+def load_tree(tree_file):
+	try:
+		fd = open(tree_file, 'rb')
+		data = cPickle.load(fd)
+		fd.close()
+	except Exception, err:
+		raise dharma_error("error reading derivation tree " + tree_file + ": " + str(err))
+
+	nodes = [dharma_node(rule) for (rule, alt, repeats, fragments) in data["nodes"]]
+
+	for (node, (rule, alt, repeats, fragments)) in zip(nodes, data["nodes"]):
+		node.alt = alt
+		node.repeats = repeats
+
+		for fragment in fragments:
+			if type(fragment) == int:
+				node.append(nodes[fragment])
+			else:
+				node.append(fragment)
+
+	return (nodes[0], data["prefix"], data["suffix"], data.get("counts", {}))
+
+# every node of a derivation tree in breadth first order as (node, parent entry, position in
+# parent), the root comes first
+def tree_entries(tree):
+	entries = [(tree, None, None)]
+
+	for (i, (node, parent, pos)) in enumerate(entries):
+		for j in range(0, len(node)):
+			if isinstance(node[j], list):
+				entries.append((node[j], i, j))
+
+	return entries
+
+def copy_node(node):
+	copy = dharma_node(node.rule)
+	copy.alt = node.alt
+	copy.repeats = node.repeats
+	copy.extend(node)
+
+	return copy
+
+# a corpus is given as derivation tree files or directories holding them, fanned out or not
+def corpus_files(corpus):
+	files = []
+
+	for path in corpus:
+		if not os.path.isdir(path):
+			files.append(path)
+			continue
+
+		found = []
+
+		for (root, dirs, names) in os.walk(path):
+			found.extend([os.path.join(root, name) for name in names if name.endswith(dharma_const.TREE_EXTENSION)])
+
+		files.extend(sorted(found))
+
+	return files
+
+# flatten nested fragment lists without recursion and join them in a single pass
+def join_fragments(fragments):
+	out = []
+	stack = [iter(fragments)]
+
+	while len(stack) != 0:
+		for fragment in stack[-1]:
+			if isinstance(fragment, list):
+				stack.append(iter(fragment))
+				break
+
+			out.append(fragment)
+		else:
+			stack.pop()
+
+	return "".join(out)
+
+def print_analysis(analysis, path):
+	analysis.dump(path)
+
+	report = analysis.report()
+	counts = [0, 0, 0]
+
+	for (name, rule) in sorted(report["rules"].items()):
+		if not rule["reachable"]:
+			print "w: " + name + " is not reachable from any variance"
+			counts[0] += 1
+		elif not rule["terminates"]:
+			print "w: " + name + " cannot terminate"
+			counts[1] += 1
+		elif not rule["bounded"]:
+			print "w: " + name + " has unbounded expected size, leaf mode cuts it off"
+			counts[2] += 1
+
+	print "i: %d rules, %d unreachable, %d non-terminating, %d unbounded" % tuple([len(report["rules"])] + counts)
+
+	if report["testcase"]["bounded"]:
+		print "i: expected testcase size %.0f bytes, %.0f%% below %.0f bytes" % (report["testcase"]["expected_size"], 100 * (1 - report["tail"]), report["testcase"]["tail_size"])
+	else:
+		print "i: expected testcase size is unbounded, it is set by LEAF_TRIGGER and the budgets"
+
+	return
+
 def usage():
-	print "u: dharma.py -i <input_lx> -o <output_dir> [-n <output_count> -p <prefix_file> -s <suffix_file> -t <tab_count>]"
+	print "u: dharma.py -i <input_lx> -o <output_dir> [-n <output_count> -p <prefix_file> -s <suffix_file> -t <tab_count> -c <cache_dir> -C -j <jobs> --seed <seed> --max-bytes <bytes> --max-depth <depth> --max-nodes <nodes> --stream <-|fifo|unix:path> --delimiter <delimiter> --index <testcase> --serve <[host:]port|unix:path> --profile <json_file> --coverage <state_file> --dedup --dedup-state <state_file> --record-trees --reduce <tree_file> --predicate <command> --mutate <tree_file|tree_dir> --pool <value> --fanout <levels> --watch <pending> --analyze <json_file>]"
 	return
 
 def main():
-	print "dharma"
-	print "hawkes 2011\n"
-
 	try:
-		opts, args = getopt.getopt(sys.argv[1:], dharma_const.DHARMA_ARGS)
+		opts, args = getopt.getopt(sys.argv[1:], dharma_const.DHARMA_ARGS, dharma_const.DHARMA_LONG_ARGS)
 	except getopt.GetoptError, err:
 		print "e: " + str(err)
 		usage()
@@ -909,12 +3401,41 @@ def main():
 	dharma_prefix = None
 	dharma_suffix = None
 	dharma_tabs = dharma_const.DEFAULT_TABS
+	dharma_cache_dir = None
+	dharma_cache = True
+	dharma_jobs = dharma_const.DEFAULT_JOBS
+	dharma_seed = None
+	dharma_budget = []
+	dharma_stream = None
+	dharma_delimiter = None
+	dharma_index = None
+	dharma_serve = None
+	dharma_profile_file = None
+	dharma_coverage_file = None
+	dharma_unique = False
+	dharma_dedup_file = None
+	dharma_record = False
+	dharma_reduce = None
+	dharma_predicate = None
+	dharma_corpus = []
+	dharma_pools = []
+	dharma_fanout = 0
+	dharma_watch = None
+	dharma_analyze = None
+	dharma_inputs = []
 
 	for o, a in opts:
-		if o == "-f":
+		if o == "-c":
+			dharma_cache_dir = a
+		elif o == "-C":
+			dharma_cache = False
+		elif o == "-f":
 			dharma_filetype = a
 		elif o == "-i":
 			dharma_input = a
+			dharma_inputs.append(a)
+		elif o == "-j":
+			dharma_jobs = int(a)
 		elif o == "-n":
 			dharma_count = int(a)
 		elif o == "-o":
@@ -925,28 +3446,121 @@ def main():
 			dharma_suffix = a
 		elif o == "-t":
 			dharma_tabs = int(a)
+		elif o == "--seed":
+			dharma_seed = int(a)
+		elif o == "--max-bytes":
+			dharma_budget.append(("MAX_OUTPUT_BYTES", int(a)))
+		elif o == "--max-depth":
+			dharma_budget.append(("MAX_EXPANSION_DEPTH", int(a)))
+		elif o == "--max-nodes":
+			dharma_budget.append(("MAX_EXPANSION_NODES", int(a)))
+		elif o == "--stream":
+			dharma_stream = a
+		elif o == "--delimiter":
+			dharma_delimiter = a.decode("string_escape")
+		elif o == "--index":
+			dharma_index = int(a)
+		elif o == "--serve":
+			dharma_serve = a
+		elif o == "--profile":
+			dharma_profile_file = a
+		elif o == "--coverage":
+			dharma_coverage_file = a
+		elif o == "--dedup":
+			dharma_unique = True
+		elif o == "--dedup-state":
+			dharma_unique = True
+			dharma_dedup_file = a
+		elif o == "--record-trees":
+			dharma_record = True
+		elif o == "--reduce":
+			dharma_reduce = a
+		elif o == "--predicate":
+			dharma_predicate = a
+		elif o == "--mutate":
+			dharma_corpus.append(a)
+		elif o == "--pool":
+			dharma_pools.append(a)
+		elif o == "--fanout":
+			dharma_fanout = int(a)
+		elif o == "--watch":
+			dharma_watch = int(a)
+		elif o == "--analyze":
+			dharma_analyze = a
 		else:
 			print "e: unknown option " + o
 			sys.exit(-1)
 
-	if dharma_input == None or dharma_output == None:
+	# keep stdout clean for testcase records, messages go to stderr instead
+	if dharma_stream == dharma_const.STREAM_STDOUT:
+		sys.stdout = sys.stderr
+
+	print "dharma"
+	print "hawkes 2011\n"
+
+	if dharma_input == None or (dharma_output == None and dharma_stream == None and dharma_serve == None and dharma_reduce == None and dharma_analyze == None):
 		print "e: input and output arguments required"
 		usage()
 		sys.exit(-1)
 
+	if dharma_index != None and dharma_seed == None:
+		print "e: regenerating a testcase with --index requires --seed"
+		sys.exit(-1)
+
+	if dharma_reduce != None and dharma_predicate == None:
+		print "e: reducing a testcase with --reduce requires --predicate"
+		sys.exit(-1)
+
+	if dharma_record and (dharma_output == None or dharma_stream != None):
+		print "e: recording derivation trees with --record-trees requires an output directory"
+		sys.exit(-1)
+
+	if dharma_fanout < 0:
+		print "e: invalid fan-out level count %d" % dharma_fanout
+		sys.exit(-1)
+
+	if dharma_watch != None and (dharma_output == None or dharma_stream != None or dharma_fanout != 0 or dharma_jobs != 1):
+		print "e: watching with --watch requires an output directory without --fanout, --stream or -j"
+		sys.exit(-1)
+
+	if dharma_watch != None and dharma_watch <= 0:
+		print "e: invalid pending testcase count %d" % dharma_watch
+		sys.exit(-1)
+
+	if dharma_count == 0 and dharma_stream == None:
+		print "e: an unbounded output count requires --stream"
+		sys.exit(-1)
+
 	try:
 		fd = open(dharma_input, 'r')
+		dharma_data = fd.read()
+		fd.close()
 	except:
 		print "e: error opening language file"
 		sys.exit(-1)
 
 	print "i: using language " + dharma_input
 
-	if os.path.isdir(dharma_output) == False:
-		print "e: output directory does not exist"
-		sys.exit(-1)
+	if dharma_stream != None:
+		dharma_output = ""
+
+		print "i: using output stream " + dharma_stream
+	elif dharma_serve != None:
+		print "i: serving on " + dharma_serve
+	elif dharma_reduce != None:
+		dharma_output = ""
 
-	print "i: using output directory " + dharma_output
+		print "i: reducing testcase tree " + dharma_reduce
+	elif dharma_analyze != None:
+		dharma_output = ""
+
+		print "i: writing grammar analysis to " + dharma_analyze
+	else:
+		if os.path.isdir(dharma_output) == False:
+			print "e: output directory does not exist"
+			sys.exit(-1)
+
+		print "i: using output directory " + dharma_output
 
 	try:
 		if dharma_prefix != None:
@@ -964,30 +3578,184 @@ def main():
 		print "e: error reading prefix or suffix file"
 		sys.exit(-1)
 
+	if dharma_serve != None:
+		server = dharma_server(prefix_data, suffix_data, dharma_tabs, dharma_cache, dharma_cache_dir, dharma_budget)
+
+		try:
+			for grammar_file in dharma_inputs:
+				print "i: loaded grammar " + server.add_grammar(grammar_file) + " from " + grammar_file
+
+			sys.stdout.flush()
+
+			server.serve(dharma_serve)
+		except dharma_error, err:
+			print "e: " + str(err)
+			sys.exit(-1)
+
+		print "i: dharma server stopped"
+
+		return
+
 	dharma = dharma_machine(dharma_output, dharma_filetype, prefix_data, suffix_data, dharma_count, dharma_tabs)
+	dharma.fanout = dharma_fanout
+
+	if dharma_cache:
+		cache_file = cache_path(dharma_input, dharma_cache_dir)
+	else:
+		cache_file = None
+
+	try:
+		print "i: processing language file"
+
+		cache_key = dharma.cache_key(dharma_data)
+
+		if cache_file != None and dharma.load_cache(cache_file, cache_key):
+			print "i: using compiled language cache " + cache_file
+		else:
+			dharma.parse(dharma_data)
+
+			if len(dharma.includes) != 0:
+				print "i: linking %d included language file(s)" % dharma.link(dharma_input, cache_file != None, dharma_cache_dir)
+
+			print "i: resolving cross-references"
+
+			dharma.resolve()
+
+			if cache_file != None:
+				if dharma.save_cache(cache_file, cache_key):
+					print "i: wrote compiled language cache " + cache_file
+				else:
+					print "w: unable to write compiled language cache " + cache_file
+
+		for ident in dharma_pools:
+			dharma.add_pool(ident)
+
+		if len(dharma.pooled) != 0:
+			print "i: pooling expansions of %d value(s)" % len(dharma.pooled)
+
+		if dharma_seed != None:
+			seed = dharma_seed
+		else:
+			seed = os.getpid()
+
+		print "i: using seed " + str(seed)
+
+		# command line budgets take precedence over %const% settings in the grammar
+		ctx = dharma.new_context(seed, dharma_budget)
+		dharma.context = ctx
+
+		# a sha1 digest has 40 hex digits to name fan-out directories with
+		if ctx.const.FANOUT_WIDTH <= 0 or dharma_fanout * ctx.const.FANOUT_WIDTH > 40:
+			print "e: invalid fan-out level count %d" % dharma_fanout
+			sys.exit(-1)
+
+		if dharma_jobs <= 0:
+			dharma_jobs = multiprocessing.cpu_count()
+
+		if dharma_stream != None:
+			dharma.open_stream(dharma_stream, dharma_delimiter)
+
+		if dharma_profile_file != None:
+			print "i: profiling rule expansions to " + dharma_profile_file
+
+			ctx.profile = dharma_profile(dharma_profile_file)
+
+		if dharma_coverage_file != None:
+			ctx.coverage = dharma_coverage(dharma_coverage_file, dharma)
+
+			print "i: coverage guided selection, %d of %d alternatives and %d pairs seen before" % ctx.coverage.summary()
+
+		if dharma_unique:
+			dharma.dedup = dharma_dedup(dharma_dedup_file, ctx.const)
+
+			print "i: suppressing duplicate testcases"
+
+		if dharma_record:
+			print "i: recording derivation trees"
+
+			ctx.record = True
+
+		if len(dharma_corpus) != 0:
+			dharma.mutator = dharma_mutator(dharma, dharma_corpus)
+
+			print "i: mutating %d derivation trees" % len(dharma.mutator.trees)
+
+		if dharma_analyze != None:
+			print_analysis(dharma_analysis(dharma), dharma_analyze)
+		elif dharma_reduce != None:
+			reducer = dharma_reducer(dharma, dharma_reduce, dharma_predicate)
+			original = len(reducer.prefix + reducer.best + reducer.suffix)
+			content = reducer.reduce()
+
+			(testcase, extension) = os.path.splitext(dharma_reduce[:len(dharma_reduce)-len(dharma_const.TREE_EXTENSION)])
+			reduced_file = testcase + dharma_const.REDUCED_INFIX + extension
+
+			try:
+				ofd = open(reduced_file, 'wb')
+				ofd.write(content)
+				ofd.close()
+			except IOError, err:
+				raise dharma_error("error writing reduced testcase " + reduced_file + ": " + str(err))
+
+			print "i: reduced %d bytes to %d bytes with %d predicate runs" % (original, len(content), reducer.runs)
+			print "i: wrote reduced testcase " + reduced_file
+		elif dharma_watch != None:
+			dharma.count = 0
+
+			print "i: keeping %d testcases pending" % dharma_watch
+
+			sys.stdout.flush()
+
+			try:
+				dharma.generate_watch(dharma_watch, dharma_input)
+			except KeyboardInterrupt:
+				print "i: watch stopped"
+		elif dharma_index != None:
+			print "i: regenerating testcase %d" % dharma_index
+
+			dharma.generate_range(dharma_index, dharma_index)
+		elif dharma_jobs == 1:
+			if dharma_stream == None:
+				dharma.write_manifest(dharma_input)
+
+			print "i: generating output"
 
-	print "i: processing language file"
+			dharma.generate()
+		else:
+			if dharma_stream == None:
+				dharma.write_manifest(dharma_input)
+
+			print "i: generating output with %d jobs" % dharma_jobs
+
+			dharma.generate_jobs(dharma_jobs)
+	except dharma_stream_closed, err:
+		print "i: " + str(err)
+	except dharma_error, err:
+		print "e: " + str(err)
+		sys.exit(-1)
 
-	for line in fd:
-		dharma.parse_line(line)
+	try:
+		if ctx.profile != None:
+			ctx.profile.dump()
 
-	print "i: resolving cross-references"
+		if ctx.coverage != None:
+			ctx.coverage.dump()
 
-	dharma.resolve_xref()
-	dharma.calculate_leaf_paths()
+			print "i: coverage, %d of %d alternatives and %d pairs seen" % ctx.coverage.summary()
 
-	seed = os.getpid()
-	random.seed(seed)
-	print "i: using seed " + str(seed)
+		if dharma.dedup != None:
+			dharma.dedup.dump()
 
-	print "i: generating output"
+			(duplicates, checked, skipped) = dharma.dedup.summary()
 
-	dharma.generate()
+			print "i: dedup, %d of %d generated testcases were duplicates (%.1f%%), %d skipped" % (duplicates, checked, 100.0 * duplicates / max(1, checked), skipped)
+	except dharma_error, err:
+		print "e: " + str(err)
+		sys.exit(-1)
 
 	print "i: dharma run complete"
 
 	return
 
 if __name__ == "__main__":
-	sys.setrecursionlimit(20000)
 	main()
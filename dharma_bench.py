@@ -0,0 +1,263 @@
+#!/usr/bin/python
+
+# Copyright 2011 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys, os, random, getopt, json, timeit, resource, platform, subprocess, cStringIO
+
+import dharma
+
+class bench_const:
+	BENCH_ARGS = "b:g:n:o:r:"
+	BENCH_LONG_ARGS = ["seed="]
+	DEFAULT_COUNT = 200
+	DEFAULT_REPEAT = 3
+	DEFAULT_SEED = 1
+	GRAMMAR_SEED = 1
+
+	# synthetic grammars as (name, values, depth, repeat ratio). values scales the grammar
+	# size, depth is the number of values a derivation passes through before a literal is
+	# reachable and repeat ratio is the share of values with a %repeat% alternative
+	SYNTHETIC = [
+		("small", 100, 1, 0.0),
+		("medium", 1000, 1, 0.0),
+		("large", 10000, 1, 0.0),
+		("deep", 1000, 100, 0.0),
+		("repeat", 1000, 1, 0.25),
+	]
+
+# write a grammar of the given shape. references always point further down the value list
+# and the last value is a literal, so every derivation terminates
+def synthetic_grammar(values, depth, repeat_ratio, seed=bench_const.GRAMMAR_SEED):
+	rng = random.Random(seed)
+	out = cStringIO.StringIO()
+
+	out.write("%section% := value\n\n")
+
+	for i in range(0, values):
+		out.write("v%d :=\n" % i)
+
+		if i % depth == depth-1 or i == values-1:
+			out.write("\tt%d\n" % i)
+
+		if i != values-1:
+			refs = (min(values-1, i+1), min(values-1, i+2))
+
+			out.write("\t(+v%d+)\n" % refs[0])
+			out.write("\t[+v%d+]\n" % refs[1])
+
+			if rng.random() < repeat_ratio:
+				out.write("\t[%%repeat%%(+v%d+, \",\")]\n" % refs[0])
+
+		out.write("\n")
+
+	out.write("%section% := variance\n\n")
+	out.write("main :=\n")
+
+	for i in range(0, values, max(1, values / 16)):
+		out.write("\t+v%d+\n" % i)
+
+	out.write("\n")
+
+	return out.getvalue()
+
+def best_time(func, repeat):
+	best = None
+
+	for r in range(0, repeat):
+		start = timeit.default_timer()
+		func()
+		elapsed = timeit.default_timer() - start
+
+		if best == None or elapsed < best:
+			best = elapsed
+
+	return best
+
+def peak_rss_kb():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# time each phase of one grammar. parse and resolve are timed on fresh machines and the best
+# of repeat runs is kept, generation is timed once over count testcases with a fixed seed
+def bench_grammar(data, count, repeat, seed):
+	result = {}
+	lines = data.count("\n")
+	machines = []
+
+	def parse():
+		machine = dharma.dharma_machine()
+		machine.parse(data)
+		machines.append(machine)
+
+	result["lines"] = lines
+	result["parse_sec"] = best_time(parse, repeat)
+	result["parse_sec_per_1k_lines"] = result["parse_sec"] * 1000.0 / max(1, lines)
+
+	machine = machines[-1]
+	parsed = list(machines)
+
+	result["resolve_xref_sec"] = best_time(lambda: parsed.pop().resolve_xref(), repeat)
+	result["leaf_costs_sec"] = best_time(machine.calculate_leaf_costs, 1)
+
+	rss_before = peak_rss_kb()
+	generated = [0]
+
+	def generate():
+		for testcase in machine.testcases(count, seed):
+			generated[0] += len(testcase)
+
+	elapsed = best_time(generate, 1)
+
+	result["testcases"] = count
+	result["generate_sec"] = elapsed
+	result["testcases_per_sec"] = count / elapsed
+	result["bytes"] = generated[0]
+	result["bytes_per_sec"] = generated[0] / elapsed
+	result["rss_before_generate_kb"] = rss_before
+	result["peak_rss_kb"] = peak_rss_kb()
+
+	return result
+
+# every grammar is measured in its own child so peak rss and %const% settings do not leak
+# between grammars
+def bench_child(data, count, repeat, seed):
+	(rfd, wfd) = os.pipe()
+	pid = os.fork()
+
+	if pid == 0:
+		os.close(rfd)
+		status = 0
+
+		try:
+			output = json.dumps(bench_grammar(data, count, repeat, seed))
+		except dharma.dharma_error, err:
+			output = json.dumps({"error": str(err)})
+			status = 1
+
+		wfd = os.fdopen(wfd, 'w')
+		wfd.write(output)
+		wfd.close()
+		os._exit(status)
+
+	os.close(wfd)
+	rfd = os.fdopen(rfd, 'r')
+	output = rfd.read()
+	rfd.close()
+	os.waitpid(pid, 0)
+
+	return json.loads(output)
+
+def revision():
+	try:
+		return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, 'w')).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def compare(baseline, results):
+	for name in sorted(results["grammars"]):
+		if not name in baseline["grammars"]:
+			continue
+
+		old = baseline["grammars"][name]
+		new = results["grammars"][name]
+
+		for key in sorted(new):
+			if key in ("lines", "testcases", "bytes") or not key in old or not isinstance(new[key], (int, float)) or old[key] == 0:
+				continue
+
+			sys.stderr.write("%-8s %-24s %14.6f %14.6f %+8.1f%%\n" % (name, key, old[key], new[key], 100.0 * (new[key] - old[key]) / old[key]))
+
+	return
+
+def usage():
+	print "u: dharma_bench.py [-g <grammar> -n <testcases> -r <repeat> -o <results_json> -b <baseline_json> --seed <seed>]"
+
+def main():
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], bench_const.BENCH_ARGS, bench_const.BENCH_LONG_ARGS)
+	except getopt.GetoptError, err:
+		print "e: " + str(err)
+		usage()
+		sys.exit(-1)
+
+	bench_grammars = []
+	bench_count = bench_const.DEFAULT_COUNT
+	bench_repeat = bench_const.DEFAULT_REPEAT
+	bench_seed = bench_const.DEFAULT_SEED
+	bench_output = None
+	bench_baseline = None
+
+	for o, a in opts:
+		if o == "-g":
+			bench_grammars.append(a)
+		elif o == "-n":
+			bench_count = int(a)
+		elif o == "-r":
+			bench_repeat = int(a)
+		elif o == "-o":
+			bench_output = a
+		elif o == "-b":
+			bench_baseline = a
+		elif o == "--seed":
+			bench_seed = int(a)
+
+	if len(bench_grammars) == 0:
+		bench_grammars.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "grammar", "svg.dg"))
+
+	grammars = []
+
+	for grammar_file in bench_grammars:
+		try:
+			fd = open(grammar_file, 'r')
+			grammars.append((os.path.splitext(os.path.basename(grammar_file))[0], fd.read()))
+			fd.close()
+		except IOError, err:
+			print "e: error opening language file: " + str(err)
+			sys.exit(-1)
+
+	for (name, values, depth, repeat_ratio) in bench_const.SYNTHETIC:
+		grammars.append((name, synthetic_grammar(values, depth, repeat_ratio)))
+
+	results = {
+		"dharma_version": dharma.dharma_const.DHARMA_VERSION,
+		"revision": revision(),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"seed": bench_seed,
+		"repeat": bench_repeat,
+		"grammars": {},
+	}
+
+	for (name, data) in grammars:
+		sys.stderr.write("i: benchmarking " + name + "\n")
+		results["grammars"][name] = bench_child(data, bench_count, bench_repeat, bench_seed)
+
+	output = json.dumps(results, indent=1, sort_keys=True)
+
+	if bench_output != None:
+		fd = open(bench_output, 'w')
+		fd.write(output + "\n")
+		fd.close()
+	else:
+		print output
+
+	if bench_baseline != None:
+		fd = open(bench_baseline, 'r')
+		compare(json.load(fd), results)
+		fd.close()
+
+	return
+
+if __name__ == "__main__":
+	main()